@@ -1,14 +1,40 @@
-try:
-    from k8s_deployer.main import (  # NOQA
-        create_function,
-        db_watcher_function,
-        remove_function,
-        send_monitoring_metrics,
-    )
-except Exception:
-    pass
-
-try:
-    from registration_backend.index import register, timeslots  # NOQA
-except Exception:
-    pass
+import importlib
+
+# handler name -> module that implements it. Every cloud function imports only the module of
+# the handler it serves, on its first call, so e.g. registration does not load kubernetes.
+ENTRYPOINTS = {
+    "create_function": "k8s_deployer.main",
+    "db_watcher_function": "k8s_deployer.main",
+    "remove_function": "k8s_deployer.main",
+    "send_monitoring_metrics": "k8s_deployer.main",
+    "register": "registration_backend.index",
+    "timeslots": "registration_backend.index",
+}
+
+
+def load_handler(name):
+    return getattr(importlib.import_module(ENTRYPOINTS[name]), name)
+
+
+def create_function(event, context):
+    return load_handler("create_function")(event, context)
+
+
+def db_watcher_function(event, context):
+    return load_handler("db_watcher_function")(event, context)
+
+
+def remove_function(event, context):
+    return load_handler("remove_function")(event, context)
+
+
+def send_monitoring_metrics(event, context):
+    return load_handler("send_monitoring_metrics")(event, context)
+
+
+def register(event, context):
+    return load_handler("register")(event, context)
+
+
+def timeslots(event, context):
+    return load_handler("timeslots")(event, context)
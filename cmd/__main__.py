@@ -1,20 +1,21 @@
+import csv
 import datetime
+import enum
+import io
+import json
 import os
 import re
 import sys
 
 import click
-from sqlalchemy import select
+from sqlalchemy import and_, case, delete, null, or_, select, text, tuple_, update
 
 from lib import util
 
 new_session = None
-init_db = None
+migrate = None
 Slot = None
-
-
-class SlotConflict(Exception):
-    pass
+KuberState = None
 
 
 @click.group()
@@ -29,85 +30,85 @@ def main(user, password, host, port, name):
     os.environ["DB_HOST"] = host
     os.environ["DB_PORT"] = port
     os.environ["DB_NAME"] = name
-    global new_session, Slot, init_db
+    global new_session, Slot, KuberState, migrate
     from lib.database import db_session as new_session_
-    from lib.database import init_db as init_db_
+    from lib.migrations import migrate as migrate_
+    from lib.models import KuberState as KuberState_
     from lib.models import Slot as Slot_
 
     new_session = new_session_
     Slot = Slot_
-    init_db = init_db_
+    KuberState = KuberState_
+    migrate = migrate_
 
 
 @main.command()
 def init():
-    init_db()
+    for migration in migrate():
+        print(f"Applied migration {migration.version}: {migration.name}")
 
 
 @main.command()
-def create_slots():
-    slots = []
+@click.option("--rules", is_flag=True, help="Read slot calendar rules (JSON) from stdin instead of slot times")
+@click.option("--days", type=int, default=7, help="With --rules: create the slots starting within this many days")
+def create_slots(rules, days):
+    if rules:
+        return create_slots_from_rules(days)
+
+    # Rows are checked first, then streamed with COPY into a temporary table and inserted
+    # with one statement, so a large list costs a few round trips and nothing on a bad row.
+    data = io.StringIO()
+    writer = csv.writer(data)
+    errors = 0
+    for number, row in enumerate(map(str.strip, sys.stdin), start=1):
+        if not row:
+            continue
+        try:
+            writer.writerow([number, *map(util.serialize_utc, parse_slot_row(row))])
+        except ValueError as e:
+            click.secho("Could not parse slot at line {} [{}]: {}".format(number, row, e), fg="red", err=True)
+            errors += 1
+    if errors:
+        raise click.ClickException("No slots created, fix the {} bad rows first".format(errors))
+
+    data.seek(0)
     with new_session() as session:
-        for row in map(str.strip, sys.stdin.readlines()):
-            if not row.strip():
-                continue
-            try:
-                slots.append(create_slot(row, session))
-            except SlotConflict as e:
-                click.secho(
-                    "Could not add slot at time [{}], it conflicts with existing slot(s): [{}]".format(
-                        row, ", ".join(util.serialize_time(slot.time) for slot, in e.args[0])
-                    ),
-                    fg="red",
-                    err=True,
-                )
-                print()
+        session.execute(text('CREATE TEMPORARY TABLE slot_import (line INTEGER, time TIMESTAMP, "end" TIMESTAMP) ON COMMIT DROP'))
+        with session.connection().connection.cursor() as cursor:
+            cursor.copy_expert('COPY slot_import (line, time, "end") FROM STDIN WITH (FORMAT csv)', data)
+        created = session.scalars(
+            text(
+                """
+                INSERT INTO slot (time, "end", enabled, email, namespace, password)
+                SELECT time, "end", false, '', '', '' FROM slot_import ORDER BY line
+                RETURNING id
+                """
+            )
+        ).all()
+        session.commit()
+    for slot_id in created:
+        print(slot_id)
+
+
+def create_slots_from_rules(days):
+    from lib.slot_calendar import SlotCalendar, generate_slots
 
+    calendar = SlotCalendar.load(sys.stdin)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with new_session() as session:
+        created = generate_slots(session, calendar, now, now + datetime.timedelta(days=days))
         session.commit()
-        for slot in slots:
-            print(slot.id)
-
-
-def create_slot(isotime, session):
-    if " " not in isotime:
-        begin = util.deserialize_time(isotime)
-        end = begin + datetime.timedelta(hours=1)
-    else:
-        begin, end = isotime.split(" ")
-        begin = util.deserialize_time(begin)
-        end = util.deserialize_time(end)
-
-    slot = Slot(
-        time=begin,
-        end=end,
-    )
-    session.add(slot)
-    return slot
-
-
-def format_slot(slot):
-    return " | ".join(
-        [
-            str(slot.id).ljust(4),
-            util.serialize_time(slot.time),
-            ("✅" if slot.enabled else "❌").ljust(len("enabled")),
-            slot.namespace.ljust(32),
-            slot.password.ljust(32),
-            slot.email,
-        ]
-    )
+    for slot_id in created:
+        print(slot_id)
 
 
-table_header = " | ".join(
-    [
-        "id".ljust(4),
-        "begin time".ljust(len(util.serialize_time(datetime.datetime.now(tz=datetime.timezone.utc)))),
-        "enabled",
-        "fqdn".ljust(32),
-        "password".ljust(32),
-        "email",
-    ]
-)
+def parse_slot_row(row):
+    # "begin" for an hour long slot, or "begin end".
+    if " " not in row:
+        begin = util.deserialize_time(row)
+        return begin, begin + datetime.timedelta(hours=1)
+    begin, end = row.split(" ")
+    return util.deserialize_time(begin), util.deserialize_time(end)
 
 
 regex = re.compile(r"((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?")
@@ -124,103 +125,195 @@ def parse_time(time_str):
     return datetime.timedelta(**{name: int(param) for (name, param) in parts.groupdict().items() if param})
 
 
-@main.command()
-@click.option("-A", default=None, metavar="a")
-@click.option("-B", default=None, metavar="b")
-def list_slots(a, b):
-    a = parse_time(a)
-    b = parse_time(b)
+def slot_selector(f):
+    # Selects slots by time and state.
+    f = click.option("--state", "states", multiple=True, help="Kubernetes state, e.g. Running, or none for never deployed")(f)
+    f = click.option("-B", default=None, metavar="b", help="Slots that started at most this long ago, e.g. 1h30m")(f)
+    f = click.option("-A", default=None, metavar="a", help="Slots starting within this long from now, e.g. 2h")(f)
+    f = click.option("--to", "end", default=None, metavar="TIME", help="Slots starting before this time")(f)
+    f = click.option("--from", "begin", default=None, metavar="TIME", help="Slots starting at or after this time")(f)
+    return f
+
+
+def slot_conditions(begin=None, end=None, a=None, b=None, states=(), table=None, around_now=False):
+    columns = (Slot.__table__ if table is None else table).c
+    now = datetime.datetime.now(datetime.timezone.utc)
+    conditions = []
+    if begin is not None:
+        conditions.append(columns.time >= util.deserialize_time(begin))
+    if end is not None:
+        conditions.append(columns.time < util.deserialize_time(end))
+    after, before = parse_time(a), parse_time(b)
+    if after is not None:
+        conditions.append(columns.time <= now + after)
+    if before is not None:
+        conditions.append(columns.time > now - before)
+    # Commands that change slots take -A and -B as a window around now: alone, either one stops at now
+    # instead of reaching every past (or future) slot.
+    if around_now and (after is None) != (before is None):
+        conditions.append(columns.time >= now if before is None else columns.time <= now)
+    if states:
+        try:
+            kuber_states = [KuberState(state) for state in states if state != "none"]
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--state")
+        state_conditions = [columns.kuber_state.in_(kuber_states)]
+        if "none" in states:
+            state_conditions.append(columns.kuber_state == None)  # noqa: E711
+        conditions.append(or_(*state_conditions))
+    return conditions
+
+
+def change_slots(selector, skip_reason, values=None):
+    # A single statement locks the selected slots, updates (or deletes, without values) those
+    # skip_reason is NULL for, and returns every selected slot with whether it was changed.
+    # Without a selector the slot ids are read from stdin.
+    conditions = slot_conditions(**selector, around_now=True)
+    requested = None
+    if not conditions:
+        requested = [int(slot_id) for slot_id in sys.stdin.read().split()]
+        conditions = [Slot.id.in_(requested)]
+
+    selected = select(Slot.id, skip_reason.label("skipped")).where(*conditions).with_for_update().cte("selected")
+    statement = delete(Slot) if values is None else update(Slot).values(**values)
+    # The reason is checked again on the row being changed, in case it changed after it was selected.
+    changed = statement.where(Slot.id == selected.c.id).where(skip_reason == None).returning(Slot.id).cte("changed")  # noqa: E711
     with new_session() as session:
-        query = select(Slot)
-        now = datetime.datetime.now(datetime.timezone.utc)
-        if a is not None:
-            query = query.where(Slot.time <= now + a)
-        if b is not None:
-            query = query.where(Slot.time > now - b)
-        slots = list(session.execute(query))
-        click.echo(table_header)
-        for (slot,) in slots:
-            click.echo(format_slot(slot))
+        rows = session.execute(
+            select(selected.c.id, selected.c.skipped, changed.c.id != None)  # noqa: E711
+            .select_from(selected.outerjoin(changed, changed.c.id == selected.c.id))
+            .order_by(selected.c.id)
+        ).all()
+        session.commit()
+
+    for slot_id in sorted(set(requested or []) - {slot_id for slot_id, _, _ in rows}):
+        click.secho("No such slot {}".format(slot_id), fg="red", err=True)
+    for slot_id, skipped, was_changed in rows:
+        if not was_changed:
+            click.secho("Slot is {}, skipped {}".format(skipped or "changed meanwhile", slot_id), fg="red", err=True)
+    return [slot_id for slot_id, _, was_changed in rows if was_changed]
+
+
+DEFAULT_COLUMNS = "id,time,enabled,namespace,password,email"
+TABLE_HEADERS = {"time": "begin time", "namespace": "fqdn"}
+TABLE_WIDTHS = {"id": 4, "time": len("2024-01-01T00:00+00:00"), "enabled": len("enabled"), "namespace": 32, "password": 32}
+STREAM_BATCH_SIZE = 1000
+
+
+def page_token(time, slot_id):
+    return "{},{}".format(time.isoformat(), slot_id)
+
+
+def parse_page_token(token):
+    time, slot_id = token.rsplit(",", 1)
+    return util.deserialize_time(time), int(slot_id)
+
+
+def plain_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+
+def table_value(name, value):
+    if name == "enabled":
+        return "✅" if value else "❌"
+    if isinstance(value, datetime.datetime):
+        return util.serialize_time(value)
+    value = plain_value(value)
+    return "" if value is None else str(value)
+
+
+def row_writer(output_format, columns, out):
+    # Writes the header, returns the function writing a row.
+    if output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        return lambda values: writer.writerow(["" if value is None else plain_value(value) for value in values])
+    if output_format == "jsonl":
+        return lambda values: out.write(json.dumps({column: plain_value(value) for column, value in zip(columns, values)}, ensure_ascii=False) + "\n")
+    out.write(" | ".join(TABLE_HEADERS.get(column, column).ljust(TABLE_WIDTHS.get(column, 0)) for column in columns) + "\n")
+    return lambda values: out.write(
+        " | ".join(table_value(column, value).ljust(TABLE_WIDTHS.get(column, 0)) for column, value in zip(columns, values)) + "\n"
+    )
 
 
 @main.command()
-def open_slots():
+@slot_selector
+@click.option("--email", default=None, help="Slots booked with a matching email, a LIKE pattern")
+@click.option("--format", "output_format", type=click.Choice(["table", "csv", "jsonl"]), default="table")
+@click.option("--columns", default=DEFAULT_COLUMNS, show_default=True, help="Comma separated slot columns")
+@click.option("--limit", type=int, default=None, help="Slots per page, all by default")
+@click.option("--after", default=None, metavar="TOKEN", help="Continue after the page that printed this token")
+@click.option("--archived", is_flag=True, help="Include archived slots")
+def list_slots(email, output_format, columns, limit, after, archived, **selector):
+    from lib.slot_archive import slot_all
+
+    table = slot_all if archived else Slot.__table__
+    columns = [column.strip() for column in columns.split(",") if column.strip()]
+    unknown = [column for column in columns if column not in table.c]
+    if unknown:
+        raise click.BadParameter("unknown columns {}".format(", ".join(unknown)), param_hint="--columns")
+
+    # (time, id) is a stable order to continue from, whatever was added or removed meanwhile.
+    query = select(*(table.c[column] for column in columns), table.c.time.label("page_time"), table.c.id.label("page_id"))
+    query = query.where(*slot_conditions(**selector, table=table)).order_by(table.c.time, table.c.id)
+    if email is not None:
+        query = query.where(table.c.email.like(email))
+    if after is not None:
+        try:
+            query = query.where(tuple_(table.c.time, table.c.id) > parse_page_token(after))
+        except ValueError:
+            raise click.BadParameter("not a page token", param_hint="--after")
+    if limit is not None:
+        query = query.limit(limit)
+
+    # click.echo flushes every line, rows go through the buffered stream instead.
+    out = click.get_text_stream("stdout")
+    write_row = row_writer(output_format, columns, out)
+    count = 0
+    last = None
     with new_session() as session:
-        for slot_id in map(int, sys.stdin.read().split()):
-            slots = list(session.execute(select(Slot).with_for_update().where(Slot.id == slot_id)))
-            if not slots:
-                click.secho("No such slot {}".format(slot_id), fg="red", err=True)
-                continue
-            (
-                [
-                    slot,
-                ],
-            ) = slots
-            if slot.email:
-                click.secho("Slot is occupied, clear it first {}".format(slot_id), fg="red", err=True)
-                continue
-            slot.enabled = True
-            session.add(slot)
-        session.commit()
+        # A server side cursor: rows arrive in batches and are written as they come.
+        for last in session.execute(query.execution_options(yield_per=STREAM_BATCH_SIZE)):
+            count += 1
+            write_row(last[: len(columns)])
+    out.flush()
+
+    if limit is not None and count == limit:
+        click.echo("Next page: --after {}".format(page_token(last.page_time, last.page_id)), err=True)
 
 
 @main.command()
-def close_slots():
-    with new_session() as session:
-        for slot_id in map(int, sys.stdin.read().split()):
-            slots = list(session.execute(select(Slot).with_for_update().where(Slot.id == slot_id)))
-            if not slots:
-                click.secho("No such slot {}".format(slot_id), fg="red", err=True)
-                continue
-            (
-                [
-                    slot,
-                ],
-            ) = slots
-            if not slot.enabled:
-                click.secho("Slot is occupied, clear it first {}".format(slot_id), fg="red", err=True)
-                continue
-            slot.enabled = False
-            session.add(slot)
-        session.commit()
+@slot_selector
+def open_slots(**selector):
+    skip_reason = case((Slot.email != "", "occupied, clear it first"), (Slot.enabled, "already open"), else_=null())
+    opened = change_slots(selector, skip_reason, dict(enabled=True))
+    click.echo("Opened {} slots".format(len(opened)), err=True)
 
 
 @main.command()
-def clear_slots():
-    with new_session() as session:
-        for slot_id in map(int, sys.stdin.read().split()):
-            slots = list(session.execute(select(Slot).with_for_update().where(Slot.id == slot_id)))
-            if not slots:
-                click.secho("No such slot {}".format(slot_id), fg="red", err=True)
-                continue
-            (
-                [
-                    slot,
-                ],
-            ) = slots
-            slot.enabled = False
-            slot.namespace = ""
-            slot.password = ""
-            slot.email = ""
-            session.add(slot)
-        session.commit()
+@slot_selector
+def close_slots(**selector):
+    closed = change_slots(selector, case((Slot.enabled.is_not(True), "already closed"), else_=null()), dict(enabled=False))
+    click.echo("Closed {} slots".format(len(closed)), err=True)
 
 
 @main.command()
-def remove_slots():
-    with new_session() as session:
-        for slot_id in map(int, sys.stdin.read().split()):
-            slots = list(session.execute(select(Slot).with_for_update().where(Slot.id == slot_id)))
-            if not slots:
-                click.secho("No such slot {}".format(slot_id), fg="red", err=True)
-                continue
-            (
-                [
-                    slot,
-                ],
-            ) = slots
-            session.delete(slot)
-        session.commit()
+@slot_selector
+def clear_slots(**selector):
+    cleared = change_slots(selector, null(), dict(enabled=False, namespace="", password="", email=""))
+    click.echo("Cleared {} slots".format(len(cleared)), err=True)
+
+
+@main.command()
+@slot_selector
+def remove_slots(**selector):
+    deployed = and_(Slot.namespace != "", Slot.kuber_state.is_distinct_from(KuberState.Removed))
+    removed = change_slots(selector, case((deployed, "deployed, wait for the watcher to remove it"), else_=null()))
+    click.echo("Removed {} slots".format(len(removed)), err=True)
 
 
 if __name__ == "__main__":
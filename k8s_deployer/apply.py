@@ -0,0 +1,90 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from .stub import base_logger
+
+logger = base_logger.getChild("apply")
+
+DEFAULT_APPLY_WORKERS = 8
+
+# Objects are applied tier by tier: everything a workload may mount or run as
+# goes first, routes go last, all the rest (CRs and workloads) in between.
+KIND_TIERS = {
+    "Secret": 0,
+    "ConfigMap": 0,
+    "ServiceAccount": 0,
+    "Role": 0,
+    "RoleBinding": 0,
+    "HTTPRoute": 2,
+}
+DEFAULT_TIER = 1
+
+
+@dataclass
+class Manifest:
+    source: str
+    body: dict
+
+    @property
+    def kind(self):
+        return self.body.get("kind", "")
+
+    @property
+    def name(self):
+        return self.body.get("metadata", {}).get("name", "")
+
+    @property
+    def tier(self):
+        return KIND_TIERS.get(self.kind, DEFAULT_TIER)
+
+    def __str__(self):
+        return f"{self.kind}/{self.name} ({self.source})"
+
+
+@dataclass
+class ApplyResult:
+    manifest: Manifest
+    elapsed: float
+    error: Exception = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class ApplyError(Exception):
+    def __init__(self, results):
+        self.results = results
+        failed = [result for result in results if not result.ok]
+        super().__init__("Failed to apply {}: {}".format(len(failed), ", ".join(str(result.manifest) for result in failed)))
+
+
+def build_tiers(manifests):
+    tiers = {}
+    for manifest in manifests:
+        tiers.setdefault(manifest.tier, []).append(manifest)
+    return [tiers[tier] for tier in sorted(tiers)]
+
+
+def _timed_apply(apply_one, manifest):
+    started = time.monotonic()
+    try:
+        apply_one(manifest)
+    except Exception as e:
+        logger.exception("Failed to apply %s", manifest)
+        return ApplyResult(manifest, time.monotonic() - started, e)
+    elapsed = time.monotonic() - started
+    logger.info("Applied %s in %.3fs", manifest, elapsed)
+    return ApplyResult(manifest, elapsed)
+
+
+def apply_manifests(manifests, apply_one, workers=DEFAULT_APPLY_WORKERS):
+    results = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="apply") as executor:
+        for tier in build_tiers(manifests):
+            tier_results = list(executor.map(lambda manifest: _timed_apply(apply_one, manifest), tier))
+            results.extend(tier_results)
+            if not all(result.ok for result in tier_results):
+                raise ApplyError(results)
+    return results
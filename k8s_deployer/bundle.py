@@ -0,0 +1,169 @@
+import copy
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+import yaml
+
+from .apply import Manifest
+from .image_config import images
+from .metrics import get_process_metrics
+from .stub import base_logger, get_jinja_env
+
+logger = base_logger.getChild("bundle")
+
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+BUNDLE_CACHE_DIR_ENV = "YT_DEMO_BUNDLE_CACHE_DIR"
+
+# Render parameters that differ between deploys. Everything else (images,
+# persistence) is part of the bundle key, so the rest of the output can be
+# rendered and parsed once and reused.
+PATCH_POINTS = (
+    "namespace",
+    "password",
+    "datalens_cypher_text",
+)
+
+
+def _sentinel(name):
+    return f"__yt_demo_bundle_{name}__"
+
+
+def render_manifests(templates, **kwargs):
+    metrics = get_process_metrics()
+    manifests = []
+    for template in templates:
+        started = time.monotonic()
+        text = get_jinja_env().get_template(template).render(**kwargs)
+        manifests.extend(Manifest(source=template, body=body) for body in yaml.load_all(text, YamlLoader) if body)
+        metrics.observe("render-duration", time.monotonic() - started, {"template": template, "stage": "render"})
+    return manifests
+
+
+def _find_patches(node, path=()):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if any(_sentinel(name) in str(key) for name in PATCH_POINTS):
+                raise ValueError(f"Patch point in a mapping key is not supported: {'.'.join(map(str, path + (key,)))}")
+            yield from _find_patches(value, path + (key,))
+    elif isinstance(node, list):
+        for index, value in enumerate(node):
+            yield from _find_patches(value, path + (index,))
+    elif isinstance(node, str) and any(_sentinel(name) in node for name in PATCH_POINTS):
+        yield path, node
+
+
+def _substitute(text, values):
+    for name in PATCH_POINTS:
+        text = text.replace(_sentinel(name), values[name])
+    return text
+
+
+@dataclass
+class Bundle:
+    key: str
+    # [(source, body, [(path, text with sentinels)])]; bodies without patches
+    # are handed out as is, so consumers must treat them as read-only.
+    objects: list
+
+    def materialize(self, **values):
+        # Rendering is paid once per bundle, what every deploy pays per template is patching its copies.
+        durations = defaultdict(float)
+        manifests = []
+        for source, body, patches in self.objects:
+            started = time.monotonic()
+            if patches:
+                body = copy.deepcopy(body)
+                for path, text in patches:
+                    node = body
+                    for step in path[:-1]:
+                        node = node[step]
+                    node[path[-1]] = _substitute(text, values)
+            manifests.append(Manifest(source=source, body=body))
+            durations[source] += time.monotonic() - started
+        metrics = get_process_metrics()
+        for source, duration in durations.items():
+            metrics.observe("render-duration", duration, {"template": source, "stage": "materialize"})
+        return manifests
+
+    def to_json(self):
+        return json.dumps({"key": self.key, "objects": self.objects})
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        return cls(
+            key=data["key"],
+            objects=[(source, body, [(tuple(path), text) for path, text in patches]) for source, body, patches in data["objects"]],
+        )
+
+
+def bundle_key(templates, persistent):
+    jinja_env = get_jinja_env()
+    digest = hashlib.sha256()
+    for template in sorted(templates):
+        source, _, _ = jinja_env.loader.get_source(jinja_env, template)
+        digest.update(template.encode())
+        digest.update(source.encode())
+    for name in sorted(images):
+        digest.update(f"{name}={images[name]}".encode())
+    digest.update(f"persistent={bool(persistent)}".encode())
+    return digest.hexdigest()
+
+
+def compile_bundle(templates, persistent, key=None):
+    manifests = render_manifests(
+        templates,
+        persistent=persistent,
+        images=images,
+        str=str,
+        **{name: _sentinel(name) for name in PATCH_POINTS},
+    )
+    return Bundle(
+        key=key or bundle_key(templates, persistent),
+        objects=[(manifest.source, manifest.body, list(_find_patches(manifest.body))) for manifest in manifests],
+    )
+
+
+_bundles = {}
+
+
+def _load_from_disk(cache_dir, key):
+    path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(path, "r") as f:
+            return Bundle.from_json(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Ignoring broken bundle cache file %s", path)
+        return None
+
+
+def _store_on_disk(cache_dir, bundle):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{bundle.key}.json")
+    with open(f"{path}.tmp", "w") as f:
+        f.write(bundle.to_json())
+    os.replace(f"{path}.tmp", path)
+
+
+def get_bundle(templates, persistent, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get(BUNDLE_CACHE_DIR_ENV)
+
+    key = bundle_key(templates, persistent)
+    bundle = _bundles.get(key)
+    if bundle is None and cache_dir:
+        bundle = _load_from_disk(cache_dir, key)
+    if bundle is None:
+        logger.info("Compiling manifest bundle %s", key)
+        bundle = compile_bundle(templates, persistent, key=key)
+        if cache_dir:
+            _store_on_disk(cache_dir, bundle)
+    _bundles[key] = bundle
+    return bundle
@@ -1,28 +1,33 @@
+import importlib
 import os
 
 import click
 
-from .db_watcher import db_driven
-from .images import refresh_images
-from .monitoring import monitoring
-from .steps import steps
 from .stub import DEMO_CONTOUR_FLAG
 
+# command name -> (module, attribute); a subcommand's module is imported only when it is invoked.
+SUBCOMMANDS = {
+    "db-driven": ("db_watcher", "db_driven"),
+    "monitoring": ("monitoring", "monitoring"),
+    "refresh-images": ("images", "refresh_images"),
+    "steps": ("steps", "steps"),
+}
 
-@click.group()
+
+class LazyGroup(click.Group):
+    def list_commands(self, ctx):
+        return sorted(SUBCOMMANDS)
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in SUBCOMMANDS:
+            return None
+        module, attribute = SUBCOMMANDS[cmd_name]
+        return getattr(importlib.import_module(f".{module}", __package__), attribute)
+
+
+@click.group(cls=LazyGroup)
 @click.pass_context
 def main(ctx):
     ctx.obj = {
         DEMO_CONTOUR_FLAG: os.environ.get("CONTOUR"),
     }
-
-
-main.add_command(db_driven)
-main.add_command(refresh_images)
-main.add_command(monitoring)
-main.add_command(steps)
-
-# db_watcher
-# images
-# monitoring
-# steps
@@ -1,13 +1,20 @@
 import datetime
 import os
-from pprint import pformat
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import click
-from kubernetes import client
-from sqlalchemy import desc, select
+from sqlalchemy import and_, func, or_, select, update
 
-from .steps import create, remove
-from .stub import base_logger, setup_k8s_config
+from .informer import get_informers
+from .mail_dispatcher import DEFAULT_MAIL_BATCH_SIZE, SmtpSettings, dispatch_mail
+from .leases import CLAIM_BATCH_SIZE, RELEASED, LeaseHeartbeat, claim_slots, held, lease_free
+from .metrics import PrometheusSink, get_process_metrics
+from .reconciler import SlotReconciler
+from .steps import create, namespace_ready, remove
+from .stub import DEMO_CONTOUR_FLAG, base_logger
+from .tracing import log_slot_trace, namespace_timeline, observe_slot_trace, slot_trace
+from .warm_pool import claim_pool_cluster, fill_pool
 
 logger = base_logger.getChild("db_watcher")
 
@@ -25,78 +32,175 @@ def db_driven(user, password, host, port, name):
     os.environ["DB_HOST"] = host
     os.environ["DB_PORT"] = port
     os.environ["DB_NAME"] = name
-    from lib.database import init_db
+    from lib.migrations import ensure_schema
 
-    init_db()
+    ensure_schema()
 
 
-@db_driven.command()
-@click.option("--prep-time", type=int, default=15)
-@click.pass_context
-def create_pending(ctx, prep_time):
+def deploy_slot(ctx, namespace, password, use_pool, resume=False):
+    # resume picks up the deploy of a worker whose lease expired: whatever it created is
+    # kept and completed rather than failing on it.
+    if use_pool:
+        try:
+            pool_namespace = claim_pool_cluster(ctx.obj, namespace, password, resume=resume)
+        except Exception:  # noqa
+            logger.exception("Could not claim a pool cluster for %s", namespace)
+            pool_namespace = None
+        if pool_namespace is not None:
+            return pool_namespace
+    ctx.invoke(create, name=namespace, password=password, resume=resume)
+    return namespace
+
+
+def deploy_claimed_slot(ctx, heartbeat, slot_id, namespace, password, use_pool, resume=False):
     from lib.database import db_session
     from lib.models import KuberState, Slot
 
-    now = datetime.datetime.now(datetime.timezone.utc)
-    pre_deploy_time = now - datetime.timedelta(minutes=prep_time)
-    post_deploy_time = now + datetime.timedelta(minutes=prep_time)
+    try:
+        deployed_namespace = deploy_slot(ctx, namespace, password, use_pool, resume)
+        values = dict(
+            kuber_state=KuberState.Published,
+            namespace=deployed_namespace,
+            published_at=datetime.datetime.now(datetime.timezone.utc),
+        )
+    except Exception:  # noqa
+        logger.exception("Exception occurred while deploying slot %s", slot_id)
+        values = dict(kuber_state=KuberState.Excepted)
 
+    heartbeat.release([slot_id])
     with db_session() as session:
-        pending_slots = list(
-            session.scalars(
-                select(Slot)
-                .with_for_update()
-                .where(Slot.email != "")
-                .where(Slot.time >= pre_deploy_time)
-                .where(Slot.time < post_deploy_time)
-                .where(Slot.kuber_state == KuberState.Empty)
-            )
+        # A worker that took over an expired lease owns the outcome now.
+        result = session.execute(
+            update(Slot).where(Slot.id == slot_id).where(held()).values(**values, **RELEASED).execution_options(synchronize_session=False)
         )
-        logger.info("Pending slots: %s", str(pending_slots))
-        for slot in pending_slots:
-            try:
-                ctx.invoke(create, name=slot.namespace, password=slot.password)
-                slot.kuber_state = KuberState.Published
-            except Exception:  # noqa
-                logger.exception("Exception occurred")
-                slot.kuber_state = KuberState.Excepted
-            session.add(slot)
         session.commit()
+    if result.rowcount:
+        logger.info("Slot %s is %s", slot_id, values["kuber_state"].value)
+    else:
+        logger.warning("Lost the lease of slot %s, dropping its outcome %s", slot_id, values["kuber_state"].value)
+
+
+def deployable(now, prep_time):
+    from lib.models import KuberState, Slot
+
+    pending = and_(
+        Slot.email != "",
+        Slot.time >= now - datetime.timedelta(minutes=prep_time),
+        Slot.time < now + datetime.timedelta(minutes=prep_time),
+        Slot.kuber_state == KuberState.Empty,
+    )
+    # Deploys of a crashed worker: its lease expired while the slot was still deploying.
+    abandoned = and_(Slot.kuber_state == KuberState.Deploying, Slot.lease_expires_at < now, Slot.end > now)
+    return or_(pending, abandoned)
 
 
 @db_driven.command()
+@click.option("--prep-time", type=int, default=15)
+@click.option("--use-pool", default=False, is_flag=True, help="Claim a warm pool cluster before deploying a new one")
+@click.option("--parallelism", type=int, default=4, help="Number of slots deployed at the same time")
 @click.pass_context
-def check_published(ctx):
+def create_pending(ctx, prep_time, use_pool, parallelism, slot_ids=None):
+    from lib.models import KuberState, Slot
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    conditions = [deployable(now, prep_time)]
+    if slot_ids is not None:
+        conditions.append(Slot.id.in_(slot_ids))
+
+    # Each worker leases only as many slots as it has free deploy threads, the rest is left to
+    # other workers. A new slot is claimed whenever a deploy finishes, so one slow namespace
+    # does not hold up the others. No row locks are held while deploying and every slot's
+    # outcome is committed as soon as its deploy is over.
+    metrics = get_process_metrics()
+    workers = max(parallelism, 1)
+    claimed_ids = []
+    running = set()
+    exhausted = False
+    with LeaseHeartbeat() as heartbeat, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deploy") as executor:
+        while True:
+            if not exhausted and len(running) < workers:
+                claimed_at = datetime.datetime.now(datetime.timezone.utc)
+                pending_slots = claim_slots(
+                    conditions,
+                    [Slot.id, Slot.namespace, Slot.password, Slot.time, Slot.booked_at],
+                    batch_size=workers - len(running),
+                    exclude_ids=claimed_ids,
+                    kuber_state=KuberState.Deploying,
+                    deploy_started_at=claimed_at,
+                )
+                exhausted = not pending_slots
+                if pending_slots:
+                    logger.info("Pending slots: %s", [slot.id for slot in pending_slots])
+                claimed_ids.extend(slot.id for slot in pending_slots)
+                heartbeat.add(slot.id for slot in pending_slots)
+
+                for slot in pending_slots:
+                    # A slot becomes deployable prep-time before its start, or when booked if that is later.
+                    deployable_at = slot.time - datetime.timedelta(minutes=prep_time)
+                    if slot.booked_at is not None:
+                        deployable_at = max(deployable_at, slot.booked_at)
+                    metrics.observe("slot-queue-wait", max((claimed_at - deployable_at).total_seconds(), 0))
+                    running.add(
+                        executor.submit(
+                            deploy_claimed_slot, ctx, heartbeat, slot.id, slot.namespace, slot.password, use_pool, slot.previous_owner is not None
+                        )
+                    )
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+
+def trace_running_slot(slot):
+    try:
+        trace = slot_trace(slot, namespace_timeline(slot.namespace))
+        log_slot_trace(trace)
+        observe_slot_trace(get_process_metrics(), trace)
+    except Exception:  # noqa
+        logger.exception("Failed to trace slot %s", slot.id)
+
+
+@db_driven.command()
+@click.option("--batch-size", type=int, default=CLAIM_BATCH_SIZE, help="Slots leased at a time")
+@click.pass_context
+def check_published(ctx, batch_size, slot_ids=None):
     from lib.database import db_session
     from lib.models import KuberState, Mail, MailReason, Slot
 
-    setup_k8s_config()
-    k8s = client.CoreV1Api()
     now = datetime.datetime.now(datetime.timezone.utc)
 
-    with db_session() as session:
-        pending_slots = list(session.scalars(select(Slot).with_for_update().where(Slot.kuber_state == KuberState.Published)))
-        logger.info("Published slots: %s", str(pending_slots))
-        for slot in pending_slots:
-            try:
-                upload_demo_data = False
-                ready = True
-                for pod in k8s.list_namespaced_pod(namespace=slot.namespace).items:
-                    if pod.metadata.owner_references[0].kind in ("StatefulSet", "ReplicaSet") and pod.status.phase != "Running":
-                        logger.info(pformat(f"Pod {pod.metadata.name} is in state {pod.status.phase}"))
-                        ready = False
-                    if (
-                        pod.metadata.owner_references[0].kind == "Job"
-                        and pod.metadata.name.startswith("upload-demo-data")
-                        and pod.status.phase == "Succeeded"
-                    ):
-                        upload_demo_data = True
-
-                if not upload_demo_data:
-                    logger.info(pformat("Job upload-demo-data has not Succeeded"))
-                    ready = False
-                if ready:
+    conditions = [Slot.kuber_state == KuberState.Published]
+    if slot_ids is not None:
+        conditions.append(Slot.id.in_(slot_ids))
+
+    claimed_ids = []
+    with LeaseHeartbeat() as heartbeat:
+        while True:
+            claimed = claim_slots(conditions, [Slot.id, Slot.namespace], batch_size=batch_size, exclude_ids=claimed_ids)
+            if not claimed:
+                break
+            logger.info("Published slots: %s", [slot.id for slot in claimed])
+            claimed_ids.extend(slot.id for slot in claimed)
+            heartbeat.add(slot.id for slot in claimed)
+
+            ready = set()
+            for slot in claimed:
+                try:
+                    if namespace_ready(slot.namespace):
+                        ready.add(slot.id)
+                except Exception:  # noqa
+                    logger.warning("Could not check slot %s", slot.id, exc_info=True)
+
+            heartbeat.release(slot.id for slot in claimed)
+            with db_session() as session:
+                for slot in session.scalars(select(Slot).where(Slot.id.in_([slot.id for slot in claimed])).where(held())):
+                    slot.lease_owner = slot.lease_expires_at = None
+                    if slot.id not in ready:
+                        continue
                     slot.kuber_state = KuberState.Running
+                    slot.running_at = now
+                    trace_running_slot(slot)
 
                     session.add(
                         Mail(
@@ -116,39 +220,90 @@ def check_published(ctx):
                             ),
                         )
                     )
-                    session.add(slot)
-            except Exception as e:  # noqa
-                logger.info(pformat(e))
-        session.commit()
+                session.commit()
+
+
+def request_removal(ctx, namespace):
+    try:
+        return ctx.invoke(remove, namespace=namespace)
+    except Exception:  # noqa
+        logger.warning("Could not remove namespace %s", namespace, exc_info=True)
+        return None
 
 
 @db_driven.command()
 @click.option("--slack-time", type=int, default=1)
+@click.option("--parallelism", type=int, default=8, help="Number of namespace deletions issued at the same time")
+@click.option("--batch-size", type=int, default=CLAIM_BATCH_SIZE, help="Slots leased at a time")
 @click.pass_context
-def remove_expired(ctx, slack_time):
+def remove_expired(ctx, slack_time, parallelism, batch_size, slot_ids=None):
     from lib.database import db_session
     from lib.models import KuberState, Slot
 
     now = datetime.datetime.now(datetime.timezone.utc)
+    # A single label-selected list answers "is it gone yet" for the slots being removed. It is
+    # taken now, so that a namespace created after an earlier list is not missed.
+    namespaces = get_informers().namespaces
+    namespaces.refresh()
+    existing = {namespace.metadata.name for namespace in namespaces.list()}
+
+    # Slots leased by a worker that is still deploying them are left alone until it is done.
+    expired_conditions = [
+        Slot.kuber_state != None,  # noqa: E711
+        Slot.kuber_state.not_in([KuberState.Removing, KuberState.Removed]),
+        Slot.end < now - datetime.timedelta(minutes=slack_time),
+    ]
+    removing_conditions = [Slot.kuber_state == KuberState.Removing, lease_free(now)]
+    if slot_ids is not None:
+        expired_conditions.append(Slot.id.in_(slot_ids))
+        removing_conditions.append(Slot.id.in_(slot_ids))
+
+    claimed_ids = []
+    with LeaseHeartbeat() as heartbeat:
+        while True:
+            expired_slots = claim_slots(expired_conditions, [Slot.id, Slot.namespace], batch_size=batch_size, exclude_ids=claimed_ids)
+            if not expired_slots:
+                break
+            logger.info("Expired slots: %s", [slot.id for slot in expired_slots])
+            claimed_ids.extend(slot.id for slot in expired_slots)
+            heartbeat.add(slot.id for slot in expired_slots)
+
+            # Deleted whether listed or not: only the API answering 404 shows a namespace is gone.
+            to_delete = [slot for slot in expired_slots if slot.namespace]
+            with ThreadPoolExecutor(max_workers=max(parallelism, 1), thread_name_prefix="remove") as executor:
+                outcomes = dict(zip((slot.id for slot in to_delete), executor.map(lambda slot: request_removal(ctx, slot.namespace), to_delete)))
 
+            heartbeat.release(slot.id for slot in expired_slots)
+            with db_session() as session:
+                for slot in session.scalars(select(Slot).where(Slot.id.in_([slot.id for slot in expired_slots])).where(held())):
+                    slot.lease_owner = slot.lease_expires_at = None
+                    outcome = outcomes.get(slot.id, False)
+                    if outcome:
+                        slot.kuber_state = KuberState.Removing
+                        slot.removal_requested_at = now
+                    elif outcome is False:
+                        slot.kuber_state = KuberState.Removed
+                        slot.removed_at = now
+                session.commit()
+
+    # Namespaces take a while to terminate; a slot counts as removed only once its namespace is
+    # gone. One missing from the list is confirmed with a delete that answers 404.
     with db_session() as session:
-        pending_slots = list(
-            session.scalars(
-                select(Slot)
-                .with_for_update()
-                .where(Slot.kuber_state != None)  # noqa: E711
-                .where(Slot.kuber_state != KuberState.Removed)
-                .where(Slot.end < now - datetime.timedelta(minutes=slack_time))
-            )
-        )
-        logger.info("Expired slots: %s", str(pending_slots))
-        for slot in pending_slots:
-            try:
-                ctx.invoke(remove, namespace=slot.namespace)
-                slot.kuber_state = KuberState.Removed
-                session.add(slot)
-            except Exception as e:  # noqa
-                logger.info(pformat(e))
+        removing_slots = session.execute(select(Slot.id, Slot.namespace).where(*removing_conditions)).all()
+    unlisted = [slot for slot in removing_slots if slot.namespace not in existing]
+    with ThreadPoolExecutor(max_workers=max(parallelism, 1), thread_name_prefix="remove") as executor:
+        gone = [
+            slot.id for slot, outcome in zip(unlisted, executor.map(lambda slot: request_removal(ctx, slot.namespace), unlisted)) if outcome is False
+        ]
+
+    with db_session() as session:
+        for slot in session.scalars(select(Slot).with_for_update(skip_locked=True).where(Slot.id.in_(gone)).where(*removing_conditions)):
+            slot.kuber_state = KuberState.Removed
+            slot.removed_at = now
+            if slot.removal_requested_at is not None:
+                elapsed = (now - slot.removal_requested_at).total_seconds()
+                logger.info("Namespace %s of slot %s is gone after %.1fs", slot.namespace, slot.id, elapsed)
+                get_process_metrics().observe("time-to-namespace-gone", elapsed)
         session.commit()
 
 
@@ -156,37 +311,140 @@ def remove_expired(ctx, slack_time):
 @click.option("--reserve-days", type=int, default=7)
 @click.option("--interval-minutes", type=int, default=30)
 @click.option("--size-minutes", type=int, default=120)
-def create_slots(reserve_days, interval_minutes, size_minutes):
+@click.option("--rules", type=click.File(), envvar="SLOT_RULES", default=None, help="Slot calendar rules (JSON), used instead of the interval")
+def create_slots(reserve_days, interval_minutes, size_minutes, rules):
     from lib.database import db_session
-    from lib.models import Slot
-
-    interval = datetime.timedelta(minutes=interval_minutes)
-    size = datetime.timedelta(minutes=size_minutes)
+    from lib.slot_calendar import SlotCalendar, generate_slots
 
+    calendar = SlotCalendar.load(rules) if rules is not None else SlotCalendar.every(interval_minutes, size_minutes)
     now = datetime.datetime.now(datetime.timezone.utc)
-    end_reserve = now + datetime.timedelta(days=reserve_days)
 
     with db_session() as session:
-        last_slot = session.scalars(select(Slot).order_by(desc(Slot.time)).limit(1)).first()
-
-        begin = last_slot.time + interval
-        while begin < end_reserve:
-            slot = Slot(
-                time=begin,
-                end=begin + size,
-                enabled=True,
-            )
-            session.add(slot)
-            begin += interval
+        created = generate_slots(session, calendar, now, now + datetime.timedelta(days=reserve_days))
         session.commit()
+    logger.info("Created %s slots", len(created))
+
+
+@db_driven.command()
+@click.option("--older-than-hours", type=int, default=24, help="Archive slots that ended longer ago than this")
+@click.option("--batch-size", type=int, default=1000, help="Slots moved per transaction")
+@click.option("--max-batches", type=int, default=None)
+def archive_slots(older_than_hours, batch_size, max_batches):
+    from lib.database import db_session
+    from lib.slot_archive import archive_slots as move_slots
+
+    started = time.monotonic()
+    moved = move_slots(db_session, datetime.timedelta(hours=older_than_hours), batch_size, max_batches)
+    logger.info("Archived %s slots in %.1fs", moved, time.monotonic() - started)
+    get_process_metrics().add("slots-archived", moved)
+
+
+@db_driven.command("fill-pool")
+@click.option("--min-size", type=int, default=0)
+@click.option("--max-size", type=int, default=3)
+@click.option("--prep-time", type=int, default=15)
+@click.option("--horizon", type=int, default=60, help="Keep a cluster ready for every slot booked within this many minutes")
+@click.pass_context
+def fill_pool_command(ctx, min_size, max_size, prep_time, horizon):
+    from lib.database import db_session
+    from lib.models import KuberState, Slot
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    with db_session() as session:
+        upcoming = session.scalars(
+            select(func.count(Slot.id))
+            .where(Slot.email != "")
+            .where(Slot.kuber_state == KuberState.Empty)
+            .where(Slot.time >= now + datetime.timedelta(minutes=prep_time))
+            .where(Slot.time < now + datetime.timedelta(minutes=horizon))
+        ).first()
+
+    size = min(max_size, max(min_size, upcoming))
+    logger.info("Upcoming bookings: %s, warm pool target: %s", upcoming, size)
+    fill_pool(ctx, size)
+
+
+@db_driven.command()
+@click.option("--smtp-host", envvar="SMTP_HOST", required=True)
+@click.option("--smtp-port", envvar="SMTP_PORT", type=int, default=465)
+@click.option("--smtp-user", envvar="SMTP_USER")
+@click.option("--smtp-password", envvar="SMTP_PASSWORD")
+@click.option("--smtp-from", envvar="SMTP_FROM", help="Sender address, the SMTP user by default")
+@click.option("--smtp-security", envvar="SMTP_SECURITY", type=click.Choice(["ssl", "starttls", "none"]), default="ssl")
+@click.option("--batch-size", type=int, default=DEFAULT_MAIL_BATCH_SIZE, help="Mails claimed and sent over one SMTP connection")
+@click.option("--max-batches", type=int, default=None)
+def send_mail(smtp_host, smtp_port, smtp_user, smtp_password, smtp_from, smtp_security, batch_size, max_batches):
+    settings = SmtpSettings(smtp_host, smtp_port, smtp_user, smtp_password, smtp_from or smtp_user, smtp_security)
+    dispatch_mail(settings, batch_size=batch_size, max_batches=max_batches)
 
 
 @db_driven.command()
 @click.option("--slack-time", type=int, default=1)
 @click.option("--prep-time", type=int, default=15)
+@click.option("--pool-min-size", type=int, default=0)
+@click.option("--pool-max-size", type=int, default=0)
+@click.option("--archive-after-hours", type=int, default=None, help="Also archive slots that ended longer ago than this")
+@click.option("--folder", default=None, help="Push deploy latency metrics to this monitoring folder")
+@click.option("--token", default=None)
 @click.pass_context
-def all(ctx, prep_time, slack_time):
-    ctx.invoke(create_pending, prep_time=prep_time)
+def all(ctx, prep_time, slack_time, pool_min_size, pool_max_size, archive_after_hours, folder, token):
+    use_pool = pool_max_size > 0
+    ctx.invoke(create_pending, prep_time=prep_time, use_pool=use_pool)
+    if use_pool:
+        ctx.invoke(fill_pool_command, min_size=pool_min_size, max_size=pool_max_size, prep_time=prep_time)
     ctx.invoke(check_published)
     ctx.invoke(remove_expired, slack_time=slack_time)
     ctx.invoke(create_slots)
+    if archive_after_hours is not None:
+        ctx.invoke(archive_slots, older_than_hours=archive_after_hours)
+    # Mail goes out here only where SMTP is configured for the watcher.
+    smtp_settings = SmtpSettings.from_env()
+    if smtp_settings is not None:
+        try:
+            dispatch_mail(smtp_settings)
+        except Exception:  # noqa
+            logger.exception("Mail dispatch failed")
+    if folder is not None:
+        metrics = get_process_metrics()
+        metrics.labels[DEMO_CONTOUR_FLAG] = ctx.obj[DEMO_CONTOUR_FLAG]
+        metrics.push(folder, token)
+
+
+@db_driven.command()
+@click.option("--slack-time", type=int, default=1)
+@click.option("--prep-time", type=int, default=15)
+@click.option("--pool-min-size", type=int, default=0)
+@click.option("--pool-max-size", type=int, default=0)
+@click.option("--check-interval", type=int, default=15, help="Seconds between readiness checks of deploying and removing slots")
+@click.option("--full-scan-interval", type=int, default=600, help="Seconds between full scans of all slots")
+@click.option("--metrics-port", type=int, default=None, help="Serve Prometheus metrics on this port")
+@click.option("--archive-after-hours", type=int, default=None, help="Also archive slots that ended longer ago than this on full scans")
+@click.pass_context
+def serve(ctx, prep_time, slack_time, pool_min_size, pool_max_size, check_interval, full_scan_interval, metrics_port, archive_after_hours):
+    use_pool = pool_max_size > 0
+    metrics = get_process_metrics()
+    metrics.labels[DEMO_CONTOUR_FLAG] = ctx.obj[DEMO_CONTOUR_FLAG]
+    if metrics_port is not None:
+        sink = PrometheusSink()
+        sink.write(metrics)
+        sink.serve(metrics_port)
+    # Readiness and removal checks are answered from the informers, which have to follow the cluster now.
+    get_informers().start(watch=True)
+
+    def reconcile(slot_ids):
+        ctx.invoke(create_pending, prep_time=prep_time, use_pool=use_pool, slot_ids=slot_ids)
+        ctx.invoke(check_published, slot_ids=slot_ids)
+        ctx.invoke(remove_expired, slack_time=slack_time, slot_ids=slot_ids)
+
+    def full_scan():
+        ctx.invoke(
+            all,
+            prep_time=prep_time,
+            slack_time=slack_time,
+            pool_min_size=pool_min_size,
+            pool_max_size=pool_max_size,
+            archive_after_hours=archive_after_hours,
+        )
+
+    SlotReconciler(reconcile, full_scan, prep_time, slack_time, check_interval, full_scan_interval, metrics=metrics).run()
@@ -0,0 +1,115 @@
+import threading
+import time
+from dataclasses import dataclass
+
+from kubernetes import client
+
+from .stub import base_logger, setup_k8s_config
+
+logger = base_logger.getChild("discovery")
+
+DISCOVERY_TTL_SECONDS = 600
+
+_JSON_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+}
+
+
+@dataclass(frozen=True)
+class ResourceInfo:
+    group: str
+    version: str
+    plural: str
+    namespaced: bool
+
+    @property
+    def api_root(self):
+        if not self.group:
+            return f"/api/{self.version}"
+        return f"/apis/{self.group}/{self.version}"
+
+    def collection_path(self, namespace=None):
+        if self.namespaced:
+            return f"{self.api_root}/namespaces/{namespace}/{self.plural}"
+        return f"{self.api_root}/{self.plural}"
+
+
+class ResourceResolver:
+    # Caches discovery documents, not clients: discovery goes through the caller's client, or
+    # one built from the current configuration, so that a warm process never keeps the token
+    # of its first invocation.
+    def __init__(self, api_client=None, ttl=DISCOVERY_TTL_SECONDS):
+        self._api_client = api_client
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._group_versions = {}
+
+    def _client(self, api_client):
+        if api_client is not None:
+            return api_client
+        if self._api_client is not None:
+            return self._api_client
+        setup_k8s_config()
+        return client.ApiClient()
+
+    def _discover(self, api_version, api_client):
+        group, _, version = api_version.rpartition("/")
+        path = f"/apis/{group}/{version}" if group else f"/api/{version}"
+        logger.info("Discovering resources of %s", api_version)
+        document = self._client(api_client).call_api(
+            path,
+            "GET",
+            header_params={"Accept": "application/json"},
+            auth_settings=["BearerToken"],
+            response_type="object",
+            _return_http_data_only=True,
+        )
+        return {
+            resource["kind"]: ResourceInfo(
+                group=group,
+                version=version,
+                plural=resource["name"],
+                namespaced=resource["namespaced"],
+            )
+            for resource in document.get("resources", [])
+            # Subresources such as pods/log share the kind of their parent.
+            if "/" not in resource["name"]
+        }
+
+    def _resources(self, api_version, api_client=None, refresh=False):
+        with self._lock:
+            cached = self._group_versions.get(api_version)
+            if refresh or cached is None or time.monotonic() - cached[0] > self._ttl:
+                cached = (time.monotonic(), self._discover(api_version, api_client))
+                self._group_versions[api_version] = cached
+            return cached[1]
+
+    def resolve(self, api_version, kind, api_client=None):
+        resources = self._resources(api_version, api_client)
+        if kind not in resources:
+            # The CRD may have been installed after the last discovery.
+            resources = self._resources(api_version, api_client, refresh=True)
+        if kind not in resources:
+            raise LookupError(f"Kind {kind} is not served by {api_version}")
+        return resources[kind]
+
+
+_resolver = ResourceResolver()
+
+
+def get_resolver():
+    return _resolver
+
+
+def create_from_spec(api_client, namespace, body):
+    resource = get_resolver().resolve(body["apiVersion"], body["kind"], api_client)
+    return api_client.call_api(
+        resource.collection_path(body.get("metadata", {}).get("namespace", namespace)),
+        "POST",
+        body=body,
+        header_params=dict(_JSON_HEADERS),
+        auth_settings=["BearerToken"],
+        response_type="object",
+        _return_http_data_only=True,
+    )
@@ -0,0 +1,184 @@
+import functools
+import threading
+import time
+
+from kubernetes import client, watch
+
+from .stub import base_logger, setup_k8s_config
+
+logger = base_logger.getChild("informer")
+
+LIST_PAGE_SIZE = 500
+WATCH_TIMEOUT_SECONDS = 300
+WATCH_RETRY_SECONDS = 5
+# Without a watch a snapshot older than this is listed again, so that warm function
+# instances do not keep answering from the list of their first invocation.
+SNAPSHOT_TTL_SECONDS = 15
+DEMO_LABEL_SELECTOR = "yt-demo=true"
+
+
+def _metadata(obj):
+    if isinstance(obj, dict):
+        metadata = obj.get("metadata", {})
+        return metadata.get("namespace"), metadata.get("name"), metadata.get("resourceVersion")
+    return obj.metadata.namespace, obj.metadata.name, obj.metadata.resource_version
+
+
+def _list_metadata(response):
+    if isinstance(response, dict):
+        metadata = response.get("metadata", {})
+        return response.get("items", []), metadata.get("continue"), metadata.get("resourceVersion")
+    return response.items, response.metadata._continue, response.metadata.resource_version
+
+
+class Informer:
+    def __init__(self, name, list_func, **list_kwargs):
+        self.name = name
+        self._list_func = list_func
+        self._list_kwargs = list_kwargs
+        self._lock = threading.RLock()
+        self._objects = {}
+        self._resource_version = None
+        self._synced = False
+        self._listed_at = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _replace(self, objects, resource_version):
+        with self._lock:
+            self._objects = {}
+            for obj in objects:
+                self._store(obj)
+            self._resource_version = resource_version
+            self._synced = True
+            self._listed_at = time.monotonic()
+
+    def _store(self, obj):
+        namespace, name, _ = _metadata(obj)
+        self._objects.setdefault(namespace, {})[name] = obj
+
+    def _delete(self, obj):
+        namespace, name, _ = _metadata(obj)
+        self._objects.get(namespace, {}).pop(name, None)
+
+    def relist(self):
+        objects = []
+        continuation_token = None
+        while True:
+            response = self._list_func(limit=LIST_PAGE_SIZE, _continue=continuation_token, **self._list_kwargs)
+            items, continuation_token, resource_version = _list_metadata(response)
+            objects.extend(items)
+            if not continuation_token:
+                break
+        logger.info("Listed %s %s at resourceVersion %s", len(objects), self.name, resource_version)
+        self._replace(objects, resource_version)
+
+    def _handle(self, event):
+        obj = event["object"]
+        with self._lock:
+            if event["type"] == "DELETED":
+                self._delete(obj)
+            elif event["type"] in ("ADDED", "MODIFIED"):
+                self._store(obj)
+            self._resource_version = _metadata(obj)[2] or self._resource_version
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            try:
+                stream = watch.Watch().stream(
+                    self._list_func,
+                    resource_version=self._resource_version,
+                    timeout_seconds=WATCH_TIMEOUT_SECONDS,
+                    allow_watch_bookmarks=True,
+                    **self._list_kwargs,
+                )
+                for event in stream:
+                    self._handle(event)
+                    if self._stopped.is_set():
+                        return
+            except client.exceptions.ApiException as e:
+                if e.status == 410:
+                    logger.info("Watch of %s expired, listing again", self.name)
+                    self.relist()
+                    continue
+                logger.exception("Watch of %s failed", self.name)
+                time.sleep(WATCH_RETRY_SECONDS)
+            except Exception:
+                logger.exception("Watch of %s failed", self.name)
+                time.sleep(WATCH_RETRY_SECONDS)
+
+    def watching(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stale(self, max_age=SNAPSHOT_TTL_SECONDS):
+        if not self._synced:
+            return True
+        return not self.watching() and time.monotonic() - self._listed_at >= max_age
+
+    def start(self, watch=False, max_age=SNAPSHOT_TTL_SECONDS):
+        with self._lock:
+            if self.stale(max_age):
+                self.relist()
+            if watch and self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name=f"informer-{self.name}", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def refresh(self):
+        # Lists again now, unless a watch keeps the snapshot current.
+        self.start(max_age=0)
+
+    def list(self, namespace=None):
+        self.start()
+        with self._lock:
+            if namespace is not None:
+                return list(self._objects.get(namespace, {}).values())
+            return [obj for objects in self._objects.values() for obj in objects.values()]
+
+    def get(self, name, namespace=None):
+        self.start()
+        with self._lock:
+            return self._objects.get(namespace, {}).get(name)
+
+
+class SharedInformers:
+    def __init__(self):
+        setup_k8s_config()
+        core = client.CoreV1Api()
+        # Pods and jobs rendered by the deployer carry the same yt-demo label as their namespace, so
+        # one informer each covers all demo namespaces without listing the rest of the cluster.
+        self.namespaces = Informer("namespaces", core.list_namespace, label_selector=DEMO_LABEL_SELECTOR)
+        self.pods = Informer("pods", core.list_pod_for_all_namespaces, label_selector=DEMO_LABEL_SELECTOR)
+        self.jobs = Informer("jobs", client.BatchV1Api().list_job_for_all_namespaces, label_selector=DEMO_LABEL_SELECTOR)
+        # Pods of the YTsaurus cluster are made by its operator without our labels, their readiness is
+        # read from the cluster resource instead.
+        self.ytsaurus = Informer(
+            "ytsaurus",
+            functools.partial(client.CustomObjectsApi().list_cluster_custom_object, "cluster.ytsaurus.tech", "v1", "ytsaurus"),
+            label_selector=DEMO_LABEL_SELECTOR,
+        )
+
+    def all(self):
+        return [self.namespaces, self.pods, self.jobs, self.ytsaurus]
+
+    def start(self, watch=False):
+        for informer in self.all():
+            informer.start(watch=watch)
+
+    def stop(self):
+        for informer in self.all():
+            informer.stop()
+
+
+_informers = None
+_informers_lock = threading.Lock()
+
+
+def get_informers():
+    global _informers
+    with _informers_lock:
+        if _informers is None:
+            _informers = SharedInformers()
+        return _informers
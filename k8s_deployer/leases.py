@@ -0,0 +1,123 @@
+import datetime
+import os
+import socket
+import threading
+import uuid
+
+from sqlalchemy import or_, select, update
+
+from .stub import base_logger
+
+logger = base_logger.getChild("leases")
+
+# A lease that was not renewed for this long belongs to a worker that is gone.
+LEASE_SECONDS = int(os.environ.get("WATCHER_LEASE_SECONDS", 120))
+CLAIM_BATCH_SIZE = 50
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+RELEASED = dict(lease_owner=None, lease_expires_at=None)
+
+
+def lease_free(now):
+    from lib.models import Slot
+
+    return or_(Slot.lease_expires_at == None, Slot.lease_expires_at < now)  # noqa: E711
+
+
+def held():
+    from lib.models import Slot
+
+    return Slot.lease_owner == WORKER_ID
+
+
+def claim_slots(conditions, columns, batch_size=CLAIM_BATCH_SIZE, exclude_ids=(), **values):
+    # Leases up to batch_size matching slots that nobody holds a live lease on and commits at
+    # once: the row locks last only as long as this statement, and SKIP LOCKED makes concurrent
+    # workers claim disjoint batches instead of queueing behind each other.
+    from lib.database import db_session
+    from lib.models import Slot
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    candidates = (
+        select(Slot.id, Slot.lease_owner.label("previous_owner"))
+        .where(*conditions)
+        .where(lease_free(now))
+        .order_by(Slot.time)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    if exclude_ids:
+        candidates = candidates.where(Slot.id.not_in(exclude_ids))
+    candidates = candidates.cte("candidates")
+
+    with db_session() as session:
+        claimed = session.execute(
+            update(Slot)
+            .where(Slot.id == candidates.c.id)
+            .values(lease_owner=WORKER_ID, lease_expires_at=now + datetime.timedelta(seconds=LEASE_SECONDS), **values)
+            .returning(*columns, candidates.c.previous_owner)
+            .execution_options(synchronize_session=False)
+        ).all()
+        session.commit()
+
+    for slot in claimed:
+        if slot.previous_owner is not None:
+            logger.warning("Took over slot %s from %s, whose lease expired", slot.id, slot.previous_owner)
+    return claimed
+
+
+class LeaseHeartbeat:
+    # Renews the leases of the slots still being worked on, so that only the leases of a
+    # crashed worker expire. Slots whose lease was taken over meanwhile are dropped.
+    def __init__(self, interval=None):
+        self.interval = interval or LEASE_SECONDS / 3
+        self.slot_ids = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+
+    def add(self, slot_ids):
+        with self._lock:
+            self.slot_ids.update(slot_ids)
+
+    def release(self, slot_ids):
+        with self._lock:
+            self.slot_ids.difference_update(slot_ids)
+
+    def renew(self):
+        from lib.database import db_session
+        from lib.models import Slot
+
+        with self._lock:
+            slot_ids = list(self.slot_ids)
+        if not slot_ids:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with db_session() as session:
+            renewed = session.scalars(
+                update(Slot)
+                .where(Slot.id.in_(slot_ids))
+                .where(held())
+                .values(lease_expires_at=now + datetime.timedelta(seconds=LEASE_SECONDS))
+                .returning(Slot.id)
+                .execution_options(synchronize_session=False)
+            ).all()
+            session.commit()
+        lost = set(slot_ids) - set(renewed)
+        if lost:
+            logger.warning("Lost the leases of slots %s", sorted(lost))
+            self.release(lost)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.renew()
+            except Exception:  # noqa
+                logger.warning("Could not renew leases", exc_info=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
@@ -0,0 +1,176 @@
+import datetime
+import os
+import smtplib
+import time
+from dataclasses import dataclass
+from email.message import EmailMessage
+from pathlib import Path
+
+from sqlalchemy import select, tuple_, update
+
+from .metrics import get_process_metrics
+from .stub import base_logger
+
+logger = base_logger.getChild("mail")
+
+DEFAULT_MAIL_BATCH_SIZE = 50
+MAX_SEND_ATTEMPTS = 5
+SMTP_TIMEOUT = 30
+# Lag from time_to_send until the mail was handed over to the SMTP server, in seconds.
+MAIL_LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+@dataclass
+class SmtpSettings:
+    host: str
+    port: int
+    user: str = None
+    password: str = None
+    sender: str = None
+    # ssl, starttls or none
+    security: str = "ssl"
+
+    @classmethod
+    def from_env(cls):
+        if not os.environ.get("SMTP_HOST"):
+            return None
+        return cls(
+            host=os.environ["SMTP_HOST"],
+            port=int(os.environ.get("SMTP_PORT", 465)),
+            user=os.environ.get("SMTP_USER"),
+            password=os.environ.get("SMTP_PASSWORD"),
+            sender=os.environ.get("SMTP_FROM") or os.environ.get("SMTP_USER"),
+            security=os.environ.get("SMTP_SECURITY", "ssl"),
+        )
+
+    def connect(self):
+        if self.security == "ssl":
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            if self.security == "starttls":
+                smtp.starttls()
+        if self.user:
+            smtp.login(self.user, self.password)
+        return smtp
+
+
+class MailTemplates:
+    # Each (locale, reason) template is compiled on first use and kept for the process.
+    def __init__(self, path=Path(__file__).with_name("mail_templates")):
+        import jinja2
+
+        self.env = jinja2.Environment(loader=jinja2.FileSystemLoader(path), autoescape=True)
+        self._templates = {}
+
+    def get(self, locale, reason):
+        key = (locale, reason)
+        if key not in self._templates:
+            self._templates[key] = self.env.get_template(f"{locale.to_template_path()}/{reason.to_template_path()}")
+        return self._templates[key]
+
+    def message(self, mail, sender):
+        message = EmailMessage()
+        message["From"] = sender
+        message["To"] = mail.email
+        message["Subject"] = mail.locale.to_subject(mail.reason)
+        message.set_content(self.get(mail.locale, mail.reason).render(**mail.data), subtype="html")
+        return message
+
+
+def send_batch(smtp, templates, mails, sender):
+    # Returns (sent, failed). A mail the server refused fails alone. A broken connection says
+    # nothing about the mail being sent: it is left with the rest of the batch for the next
+    # round, without counting as a failed attempt.
+    sent, failed = [], []
+    for mail in mails:
+        try:
+            smtp.send_message(templates.message(mail, sender))
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            logger.warning("Could not send %s mail to %s", mail.reason.value, mail.email, exc_info=True)
+            failed.append(mail)
+            continue
+        except (smtplib.SMTPException, OSError):
+            logger.exception("SMTP connection failed while sending %s mail to %s", mail.reason.value, mail.email)
+            break
+        except Exception:  # noqa
+            logger.exception("Could not render %s mail to %s", mail.reason.value, mail.email)
+            failed.append(mail)
+            continue
+        sent.append((mail, datetime.datetime.now(datetime.timezone.utc)))
+    return sent, failed
+
+
+def _mail_key(mail):
+    return mail.time_to_send, mail.email, mail.reason, mail.locale
+
+
+def _mail_keys_in(keys):
+    from lib.models import Mail
+
+    return tuple_(Mail.time_to_send, Mail.email, Mail.reason, Mail.locale).in_(keys)
+
+
+def dispatch_mail(settings, templates=None, batch_size=DEFAULT_MAIL_BATCH_SIZE, max_batches=None):
+    from lib.database import db_session
+    from lib.models import Mail
+
+    templates = templates or MailTemplates()
+    metrics = get_process_metrics()
+    started = time.monotonic()
+    total_sent = batches = 0
+    # Not claimed again in this run, a failed mail is retried by the next one.
+    failed_keys = []
+
+    while max_batches is None or batches < max_batches:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        claim = (
+            select(Mail)
+            .where(Mail.sent.is_(False))
+            .where(Mail.attempts < MAX_SEND_ATTEMPTS)
+            .where(Mail.time_to_send <= now)
+            .order_by(Mail.time_to_send)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        if failed_keys:
+            claim = claim.where(~_mail_keys_in(failed_keys))
+        with db_session() as session:
+            # The rows stay locked until they are marked, so concurrent dispatchers skip them.
+            mails = list(session.scalars(claim))
+            if not mails:
+                break
+            batches += 1
+            smtp = settings.connect()
+            try:
+                sent, failed = send_batch(smtp, templates, mails, settings.sender)
+            finally:
+                try:
+                    smtp.quit()
+                except (smtplib.SMTPException, OSError):
+                    smtp.close()
+
+            lags = [(mail.reason.value, max((sent_at - mail.time_to_send).total_seconds(), 0)) for mail, sent_at in sent]
+            if sent:
+                keys = _mail_keys_in([_mail_key(mail) for mail, _ in sent])
+                session.execute(update(Mail).where(keys).values(sent=True).execution_options(synchronize_session=False))
+            if failed:
+                failed_keys.extend(_mail_key(mail) for mail in failed)
+                keys = _mail_keys_in([_mail_key(mail) for mail in failed])
+                session.execute(update(Mail).where(keys).values(attempts=Mail.attempts + 1).execution_options(synchronize_session=False))
+            session.commit()
+
+        for reason, lag in lags:
+            metrics.observe("mail-lag", lag, {"reason": reason}, buckets=MAIL_LAG_BUCKETS)
+        total_sent += len(sent)
+        logger.info("Mail batch %s: %s sent, %s failed", batches, len(sent), len(failed))
+        if len(sent) + len(failed) < len(mails):
+            # The connection broke, the rest waits for the next run.
+            break
+
+    elapsed = time.monotonic() - started
+    metrics.add("mail-sent", total_sent)
+    metrics.add("mail-failed", len(failed_keys))
+    metrics.add("mail-throughput", total_sent / elapsed if elapsed > 0 else 0)
+    logger.info("Sent %s mails (%s failed) in %.1fs", total_sent, len(failed_keys), elapsed)
+    return total_sent, len(failed_keys)
@@ -1,15 +1,20 @@
 import base64
 import json
+import logging
 import os
 from pathlib import Path
 
 from click.testing import CliRunner
 from kubernetes import client
 
+from lib.logs import flush_logs
+
 from .cli import main
 from .stub import base_logger as logger
 from .stub import setup_k8s_config
 
+MONITORING_FOLDER = "b1grh7kscp81dtkgs4rk"
+
 
 def configure_k8s(token):
     configuration = client.configuration.Configuration()
@@ -32,8 +37,13 @@ def configure_k8s(token):
 def run_cli(command):
     runner = CliRunner(mix_stderr=False)
     result = runner.invoke(main, command, catch_exceptions=True)
-    logger.info("Result of a command (stdout): {}".format(result.stdout))
-    logger.exception("Result of a command (stderr): {}".format(result.stderr))
+    # Output is returned in the response, only a summary is logged. Arguments may hold a token.
+    if result.exception is not None and not isinstance(result.exception, SystemExit):
+        logger.error("Command %s failed", command[:2], exc_info=result.exc_info)
+    else:
+        logger.log(logging.WARNING if result.exit_code else logging.INFO, "Command %s exited with %s", command[:2], result.exit_code)
+    logger.debug("Output of %s: %s, stderr: %s", command[:2], result.stdout, result.stderr)
+    flush_logs()
     return {
         "statusCode": 200,
         "headers": {"Content-Type": "application/json"},
@@ -47,7 +57,20 @@ def run_cli(command):
 
 def db_watcher_function(event, context):
     configure_k8s(context.token["access_token"])
-    return run_cli(["db-driven", "all", "--prep-time", "10", "--slack-time", "3"])
+    return run_cli(
+        [
+            "db-driven",
+            "all",
+            "--prep-time",
+            "10",
+            "--slack-time",
+            "3",
+            "--folder",
+            MONITORING_FOLDER,
+            "--token",
+            context.token["access_token"],
+        ]
+    )
 
 
 def parse_event(event):
@@ -82,7 +105,7 @@ def send_monitoring_metrics(event, context):
             "monitoring",
             "all",
             "--folder",
-            "b1grh7kscp81dtkgs4rk",
+            MONITORING_FOLDER,
             "--token",
             context.token["access_token"],
         ]
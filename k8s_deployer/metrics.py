@@ -0,0 +1,318 @@
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from .stub import base_logger
+
+logger = base_logger.getChild("metrics")
+
+METRICS_BUFFER_ENV = "YT_DEMO_METRICS_BUFFER"
+CLOUD_MONITORING_URL = "https://monitoring.api.cloud.yandex.net/monitoring/v2/data/write"
+# The write API accepts at most 10000 points per request.
+PUSH_BATCH_SIZE = 5000
+MAX_BUFFERED_BATCHES = 500
+PUSH_ATTEMPTS = 4
+PUSH_BACKOFF_SECONDS = 1.0
+PUSH_TIMEOUT = (5, 30)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800)
+
+
+def _series_key(component, labels):
+    return component, tuple(sorted(labels.items()))
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield "", {}, self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self):
+        for bound, count in zip(self.buckets, self.counts):
+            yield "-bucket", {"le": str(bound)}, count
+        yield "-bucket", {"le": "+Inf"}, self.count
+        yield "-sum", {}, self.sum
+        yield "-count", {}, self.count
+
+
+class Metrics:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _get(self, cls, component, labels, **kwargs):
+        labels = labels or {}
+        key = _series_key(component, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = (cls(**kwargs), labels)
+            if not isinstance(series[0], cls):
+                raise TypeError(f"{component} {labels} is a {series[0].kind}, not a {cls.kind}")
+            return series[0]
+
+    def add(self, component, value, labels=None):
+        self._get(Gauge, component, labels).set(value)
+
+    def observe(self, component, value, labels=None, buckets=DEFAULT_BUCKETS):
+        histogram = self._get(Histogram, component, labels, buckets=buckets)
+        with self._lock:
+            histogram.observe(value)
+
+    def series(self):
+        with self._lock:
+            return [(component, series, labels) for (component, _), (series, labels) in self._series.items()]
+
+    def to_list(self, ts=None):
+        points = []
+        for component, series, labels in self.series():
+            for suffix, extra_labels, value in series.samples():
+                point = {
+                    "name": self.name,
+                    "labels": {
+                        **self.labels,
+                        **labels,
+                        **extra_labels,
+                        "signal": component + suffix,
+                    },
+                    "value": value,
+                }
+                if ts is not None:
+                    point["ts"] = ts
+                points.append(point)
+        return points
+
+    def flush(self, sinks):
+        for sink in sinks:
+            try:
+                sink.write(self)
+            except Exception:
+                logger.exception("Failed to write metrics to %s", type(sink).__name__)
+
+    def push(self, folder, token):
+        self.flush([get_cloud_monitoring_sink(folder, token)])
+
+
+class MetricsBuffer:
+    # Batches that could not be pushed yet; kept in a file when a path is given so
+    # they survive until the next run instead of being lost with the process. The file is
+    # appended to, and rewritten only when a drain leaves some of it.
+    def __init__(self, path=None):
+        self.path = path
+        self._batches = []
+
+    def _load(self):
+        if self.path is None:
+            return list(self._batches)
+        try:
+            with open(self.path, "r") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _store(self, batches):
+        batches = batches[-MAX_BUFFERED_BATCHES:]
+        if self.path is None:
+            self._batches = batches
+            return
+        if not batches:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            return
+        with open(f"{self.path}.tmp", "w") as f:
+            for batch in batches:
+                f.write(json.dumps(batch) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def append(self, points):
+        batches = [points[start : start + PUSH_BATCH_SIZE] for start in range(0, len(points), PUSH_BATCH_SIZE)]
+        if self.path is None:
+            self._store(self._batches + batches)
+            return
+        with open(self.path, "a") as f:
+            for batch in batches:
+                f.write(json.dumps(batch) + "\n")
+
+    def drain(self, send):
+        batches = self._load()
+        sent = 0
+        for batch in batches:
+            if not send(batch):
+                break
+            sent += 1
+        if sent or len(batches) > MAX_BUFFERED_BATCHES:
+            self._store(batches[sent:])
+        return sent, len(batches) - sent
+
+
+class Sink:
+    def write(self, metrics):
+        raise NotImplementedError
+
+
+class CloudMonitoringSink(Sink):
+    def __init__(self, folder, token, buffer=None, attempts=PUSH_ATTEMPTS, backoff=PUSH_BACKOFF_SECONDS, timeout=PUSH_TIMEOUT):
+        self.folder = folder
+        self.token = token
+        self.buffer = buffer if buffer is not None else MetricsBuffer(os.environ.get(METRICS_BUFFER_ENV))
+        self.attempts = attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def _send(self, points):
+        data = json.dumps({"metrics": points})
+        for attempt in range(self.attempts):
+            try:
+                response = self._session.post(
+                    f"{CLOUD_MONITORING_URL}?folderId={self.folder}&service=custom",
+                    headers={
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {self.token}",
+                    },
+                    data=data,
+                    timeout=self.timeout,
+                )
+                logger.info("Response code: %s, body: %s", response.status_code, response.text)
+                if response.status_code < 500 and response.status_code != 429:
+                    # Other client errors will not go away on retry, so the batch is dropped.
+                    return True
+            except requests.RequestException:
+                logger.exception("Failed to push %s metrics to %s/custom", len(points), self.folder)
+            if attempt + 1 < self.attempts:
+                time.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+        return False
+
+    def write(self, metrics):
+        points = metrics.to_list(ts=datetime.datetime.now(datetime.timezone.utc).isoformat())
+        logger.info("Pushing %s metrics to %s/custom", len(points), self.folder)
+        self.buffer.append(points)
+        sent, pending = self.buffer.drain(self._send)
+        logger.info("Pushed %s metric batches, %s left in the buffer", sent, pending)
+
+
+_cloud_monitoring_sinks = {}
+_cloud_monitoring_sinks_lock = threading.Lock()
+
+
+def get_cloud_monitoring_sink(folder, token):
+    # One per process and folder, so that batches a push could not send stay buffered
+    # for the next push of a warm instance. The token may change between invocations.
+    with _cloud_monitoring_sinks_lock:
+        sink = _cloud_monitoring_sinks.get(folder)
+        if sink is None:
+            sink = _cloud_monitoring_sinks[folder] = CloudMonitoringSink(folder, token)
+        sink.token = token
+        return sink
+
+
+def _prometheus_name(name):
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for key, value in labels.items()}
+    return "{" + ",".join(f'{_prometheus_name(key)}="{value}"' for key, value in escaped.items()) + "}"
+
+
+def render_prometheus(metrics):
+    lines = []
+    typed = set()
+    for component, series, labels in sorted(metrics.series(), key=lambda item: item[0]):
+        family = _prometheus_name(f"{metrics.name}_{component}")
+        if family not in typed:
+            lines.append(f"# TYPE {family} {series.kind}")
+            typed.add(family)
+        for suffix, extra_labels, value in series.samples():
+            all_labels = {**{k: v for k, v in metrics.labels.items() if v is not None}, **labels, **extra_labels}
+            lines.append(f"{family}{_prometheus_name(suffix)}{_prometheus_labels(all_labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusSink(Sink):
+    # Renders the registered metrics on every scrape, so live registries are always current.
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def write(self, metrics):
+        with self._lock:
+            self._metrics[metrics.name] = metrics
+
+    def render(self):
+        with self._lock:
+            registered = list(self._metrics.values())
+        return "".join(render_prometheus(metrics) for metrics in registered)
+
+    def serve(self, port, host="0.0.0.0"):
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="prometheus", daemon=True).start()
+        logger.info("Serving metrics on %s:%s/metrics", host, self._server.server_port)
+        return self._server.server_port
+
+
+_process_metrics = None
+_process_metrics_lock = threading.Lock()
+
+
+def get_process_metrics():
+    # Internals of the deployer itself: reconciler, deploy and removal latencies.
+    global _process_metrics
+    with _process_metrics_lock:
+        if _process_metrics is None:
+            _process_metrics = Metrics(name="demo-manager", labels={})
+        return _process_metrics
@@ -1,66 +1,27 @@
-import datetime
-import json
 import os
 
 import click
-import requests
-from kubernetes import client
-from sqlalchemy import func, select
 
 from .stub import (
     DEMO_CONTOUR_FLAG,
-    MONITORING_DEFAULT_DEMAND_MARGIN,
-    MONITORING_DEFAULT_PING_MARGIN,
     base_logger,
-    setup_k8s_config,
 )
+from .informer import get_informers
+from .metrics import Metrics
+from .probes import (
+    DEFAULT_PROBE_PARALLELISM,
+    DEFAULT_PROBE_TIMEOUT,
+    demo_probes,
+    probe_codes,
+    probe_latencies,
+    run_probes,
+)
+from .slot_counters import count_slots
+from .warm_pool import POOL_LABEL, PoolState, pool_occupancy
 
 logger = base_logger.getChild("metrics")
 
 
-class Metrics:
-    def __init__(self, name, labels):
-        self.name = name
-        self.stored = []
-        self.labels = labels
-
-    def add(self, component, value, labels=None):
-        if labels is None:
-            labels = {}
-        self.stored.append((component, value, labels))
-
-    def to_list(self):
-        return [
-            {
-                "name": self.name,
-                "labels": {
-                    **self.labels,
-                    **labels,
-                    "signal": component,
-                },
-                "value": value,
-            }
-            for (component, value, labels) in self.stored
-        ]
-
-    def push(self, folder, token):
-        data = json.dumps({"metrics": self.to_list()})
-        logger.info("Pushing metrics to %s/custom: %s", folder, data)
-        response = requests.post(
-            f"https://monitoring.api.cloud.yandex.net/monitoring/v2/data/write?folderId={folder}&service=custom",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token}",
-            },
-            data=data,
-        )
-        logger.info(
-            "Response code: %s, json: %s",
-            response.status_code,
-            json.dumps(response.json()),
-        )
-
-
 @click.group()
 @click.option("--user", envvar="DB_USER")
 @click.option("--password", envvar="DB_PASS")
@@ -74,53 +35,40 @@ def monitoring(ctx, user, password, host, port, name):
     os.environ["DB_HOST"] = host
     os.environ["DB_PORT"] = port
     os.environ["DB_NAME"] = name
-    from lib.database import init_db
+    from lib.migrations import ensure_schema
 
-    init_db()
+    ensure_schema()
 
 
 @monitoring.command()
+@click.option("--parallelism", type=int, default=DEFAULT_PROBE_PARALLELISM, help="Number of demo probes running at the same time")
+@click.option("--connect-timeout", type=float, default=DEFAULT_PROBE_TIMEOUT[0])
+@click.option("--read-timeout", type=float, default=DEFAULT_PROBE_TIMEOUT[1])
 @click.pass_obj
-def liveness(obj, metrics=None):
-    from lib.database import db_session
-    from lib.models import Slot
-
-    now = datetime.datetime.now(datetime.timezone.utc)
-
-    with db_session() as session:
-        demand = session.scalars(
-            select(func.count(Slot.id))
-            .where(Slot.email != "")
-            .where(Slot.time <= now + datetime.timedelta(minutes=MONITORING_DEFAULT_DEMAND_MARGIN))
-            .where(Slot.end >= now)
-        ).first()
-        promised = session.scalars(select(func.count(Slot.id)).where(Slot.email != "").where(Slot.time <= now).where(Slot.end >= now)).first()
+def liveness(obj, parallelism, connect_timeout, read_timeout, metrics=None, counts=None):
+    if counts is None:
+        counts = count_slots()
+    demand = counts["demand"]
+    promised = counts["promised"]
 
     logger.info("demand: %s, promised: %s", demand, promised)
 
     if metrics is not None:
-        metrics.add("demand", demand)
-        metrics.add("promised", promised)
+        counts.add_to(metrics, ("demand", "promised"))
 
-    setup_k8s_config()
-    k8s = client.CoreV1Api()
-    namespaces = []
-    continuation_token = None
     labels = {
         "yt-demo": "true",
     }
     if obj[DEMO_CONTOUR_FLAG] is not None:
         labels[DEMO_CONTOUR_FLAG] = obj[DEMO_CONTOUR_FLAG]
 
-    while True:
-        resp = k8s.list_namespace(
-            label_selector=",".join(f"{key}={value}" for key, value in labels.items()),
-            _continue=continuation_token,
-        )
-        namespaces += resp.items
-        continuation_token = resp.metadata._continue
-        if continuation_token is None:
-            break
+    namespaces = [
+        namespace
+        for namespace in get_informers().namespaces.list()
+        if all((namespace.metadata.labels or {}).get(key) == value for key, value in labels.items())
+        # Unclaimed warm pool clusters do not serve any slot yet.
+        and (namespace.metadata.labels or {}).get(POOL_LABEL) not in (PoolState.Warming, PoolState.Free)
+    ]
     existent = len([namespace for namespace in namespaces])
 
     logger.info("current existent: %s", existent)
@@ -128,84 +76,64 @@ def liveness(obj, metrics=None):
     if metrics is not None:
         metrics.add("existent", existent)
 
-    now = datetime.datetime.now(datetime.timezone.utc)
-
-    with db_session() as session:
-        demanded_slots = [
-            (slot.namespace, slot.password)
-            for slot in session.scalars(
-                select(Slot)
-                .where(Slot.email != "")
-                .where(Slot.time <= now + datetime.timedelta(minutes=MONITORING_DEFAULT_PING_MARGIN))
-                .where(Slot.end >= now)
-            )
-        ]
-    ui_codes = {i: 0 for i in range(1, 6)}
-    jupyter_codes = {i: 0 for i in range(1, 6)}
-    for namespace, password in demanded_slots:
-        ui_login_response = requests.post(
-            f"https://yt-{namespace}.demo.ytsaurus.tech/api/yt/ytdemo/login",
-            data=json.dumps({"username": "admin", "password": password}),
-        )
-
-        logger.info(
-            "UI login response code: %s for demo: %s",
-            ui_login_response.status_code,
-            namespace,
-        )
-        ui_codes[ui_login_response.status_code // 100] += 1
-
-        jupyter_response = requests.get(f"https://jupyter-{namespace}.demo.ytsaurus.tech")
-        logger.info(
-            "Jupyter response code: %s for demo: %s",
-            jupyter_response.status_code,
-            namespace,
-        )
-
-        jupyter_codes[jupyter_response.status_code // 100] += 1
+    timeout = (connect_timeout, read_timeout)
+    demanded_slots = counts.demanded_slots
+    results = run_probes([probe for namespace, password in demanded_slots for probe in demo_probes(namespace, password)], parallelism, timeout)
+
+    ui_codes = probe_codes(results, "ui")
+    jupyter_codes = probe_codes(results, "jupyter")
 
     logger.info("UI codes: %s", str(ui_codes))
     logger.info("Jupyter codes: %s", str(jupyter_codes))
     if metrics is not None:
-        for code in ui_codes:
-            metrics.add("ui-response-code", ui_codes[code], {"code": f"{code}xx"})
-        for code in jupyter_codes:
-            metrics.add("jupyter-response-code", jupyter_codes[code], {"code": f"{code}xx"})
+        for kind, codes in (("ui", ui_codes), ("jupyter", jupyter_codes)):
+            for code, count in codes.items():
+                metrics.add(f"{kind}-response-code", count, {"code": code})
+            for q, latency in probe_latencies(results, kind).items():
+                metrics.add(f"{kind}-latency", latency, {"quantile": f"p{q}"})
 
     metrics.add("not-allocated", demand - existent)
-    metrics.add("no-ui-ping", demand - ui_codes[2])
-    metrics.add("no-jupyter-ping", demand - jupyter_codes[2])
+    metrics.add("no-ui-ping", demand - ui_codes["2xx"])
+    metrics.add("no-jupyter-ping", demand - jupyter_codes["2xx"])
 
 
 @monitoring.command()
-def opened(metrics=None):
-    from lib.database import db_session
-    from lib.models import Slot
+def opened(metrics=None, counts=None):
+    if counts is None:
+        counts = count_slots()
+
+    logger.info(
+        "opened_1d: %s, opened_4d: %s, opened_after_4d: %s",
+        counts["opened_1d"],
+        counts["opened_4d"],
+        counts["opened_after_4d"],
+    )
+
+    if metrics is not None:
+        counts.add_to(metrics, ("opened_1d", "opened_4d", "opened_after_4d"))
 
-    now = datetime.datetime.now(datetime.timezone.utc)
 
-    with db_session() as session:
-        opened_1d = session.scalars(
-            select(func.count(Slot.id)).where(Slot.enabled).where(Slot.time > now).where(Slot.time <= now + datetime.timedelta(days=1))
-        ).first()
+@monitoring.command()
+def slots(metrics=None, counts=None):
+    if counts is None:
+        counts = count_slots()
+    keys = [counter.key for counter in counts.counters if counter.component in ("slots", "booked")]
 
-        opened_4d = session.scalars(
-            select(func.count(Slot.id)).where(Slot.enabled).where(Slot.time > now).where(Slot.time <= now + datetime.timedelta(days=4))
-        ).first()
+    logger.info("slot counters: %s", {key: counts[key] for key in keys})
 
-        opened_after_4d = session.scalars(select(func.count(Slot.id)).where(Slot.enabled).where(Slot.time > now + datetime.timedelta(days=4))).first()
+    if metrics is not None:
+        counts.add_to(metrics, keys)
 
-    logger.info(
-        "opened_1d: %s, opened_4d: %s, opened_after_4d: %s",
-        opened_1d,
-        opened_4d,
-        opened_after_4d,
-    )
+
+@monitoring.command()
+@click.pass_obj
+def pool(obj, metrics=None):
+    occupancy = pool_occupancy(obj)
+    logger.info("warm pool occupancy: %s", occupancy)
 
     if metrics is not None:
-        metrics.add("opened", opened_1d, {"interval": "1d"})
-        metrics.add("opened", opened_4d, {"interval": "4d"})
-        metrics.add("opened", opened_after_4d, {"interval": "afeter_4d"})
+        for state, count in occupancy.items():
+            metrics.add("pool", count, {"state": state})
 
 
 @monitoring.command("all")
@@ -220,13 +148,27 @@ def all_monitorings(ctx, folder, token):
         },
     )
 
+    try:
+        counts = count_slots()
+    except Exception as e:
+        logger.exception(e)
+        counts = None
+
     for check in [
         liveness,
         opened,
+        slots,
     ]:
+        if counts is None:
+            break
         try:
-            ctx.invoke(check, metrics=metrics)
+            ctx.invoke(check, metrics=metrics, counts=counts)
         except Exception as e:
             logger.exception(e)
 
+    try:
+        ctx.invoke(pool, metrics=metrics)
+    except Exception as e:
+        logger.exception(e)
+
     metrics.push(folder, token)
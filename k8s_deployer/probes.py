@@ -0,0 +1,115 @@
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .stub import base_logger
+
+logger = base_logger.getChild("probes")
+
+DEFAULT_PROBE_PARALLELISM = 16
+# (connect, read) seconds; a hung demo must not hold up the whole metrics run.
+DEFAULT_PROBE_TIMEOUT = (3, 10)
+LATENCY_QUANTILES = (50, 90, 99)
+
+
+@dataclass
+class Probe:
+    kind: str
+    namespace: str
+    method: str
+    url: str
+    data: str = None
+
+
+@dataclass
+class ProbeResult:
+    probe: Probe
+    elapsed: float
+    status_code: int = None
+    error: str = None
+
+    @property
+    def code_class(self):
+        if self.status_code is None:
+            return "error"
+        return f"{self.status_code // 100}xx"
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def demo_probes(namespace, password):
+    return [
+        Probe(
+            kind="ui",
+            namespace=namespace,
+            method="POST",
+            url=f"https://yt-{namespace}.demo.ytsaurus.tech/api/yt/ytdemo/login",
+            data=json.dumps({"username": "admin", "password": password}),
+        ),
+        Probe(
+            kind="jupyter",
+            namespace=namespace,
+            method="GET",
+            url=f"https://jupyter-{namespace}.demo.ytsaurus.tech",
+        ),
+    ]
+
+
+def _run_probe(session, probe, timeout):
+    started = time.monotonic()
+    try:
+        response = session.request(probe.method, probe.url, data=probe.data, timeout=timeout)
+        result = ProbeResult(probe=probe, elapsed=time.monotonic() - started, status_code=response.status_code)
+    except requests.RequestException as e:
+        result = ProbeResult(probe=probe, elapsed=time.monotonic() - started, error=type(e).__name__)
+    logger.info(
+        "%s probe of %s: %s in %.3fs",
+        probe.kind,
+        probe.namespace,
+        result.status_code or result.error,
+        result.elapsed,
+    )
+    return result
+
+
+def run_probes(probes, parallelism=DEFAULT_PROBE_PARALLELISM, timeout=DEFAULT_PROBE_TIMEOUT):
+    if not probes:
+        return []
+    workers = max(min(parallelism, len(probes)), 1)
+    with make_session(workers) as session:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe") as executor:
+            return list(executor.map(lambda probe: _run_probe(session, probe, timeout), probes))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def probe_codes(results, kind):
+    codes = {f"{i}xx": 0 for i in range(1, 6)}
+    codes["error"] = 0
+    for result in results:
+        if result.probe.kind == kind:
+            codes[result.code_class] += 1
+    return codes
+
+
+def probe_latencies(results, kind):
+    latencies = [result.elapsed for result in results if result.probe.kind == kind]
+    if not latencies:
+        return {}
+    return {q: percentile(latencies, q) for q in LATENCY_QUANTILES}
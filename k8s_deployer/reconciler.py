@@ -0,0 +1,172 @@
+import datetime
+import heapq
+import select
+import time
+
+from sqlalchemy import or_
+from sqlalchemy import select as sql_select
+
+from .stub import base_logger
+
+logger = base_logger.getChild("reconciler")
+
+SLOT_CHANNEL = "slot_changed"
+RECONNECT_DELAY_SECONDS = 5
+
+
+# Changed slots arrive through LISTEN/NOTIFY (see the slot trigger in lib.database), slot start
+# and end times are kept as timers, slots waiting on kubernetes are polled and a periodic full
+# scan catches whatever was missed.
+class SlotReconciler:
+
+    def __init__(self, reconcile, full_scan, prep_time, slack_time, check_interval, full_scan_interval, metrics=None):
+        self._reconcile = reconcile
+        self._full_scan = full_scan
+        self._prep_time = datetime.timedelta(minutes=prep_time)
+        self._slack_time = datetime.timedelta(minutes=slack_time)
+        self._check_interval = check_interval
+        self._full_scan_interval = full_scan_interval
+        self._timers = []
+        self._scheduled = set()
+        self._connection = None
+        self._metrics = metrics
+        self._errors = 0
+
+    def _listen(self):
+        from lib.database import engine
+
+        connection = engine.raw_connection()
+        # The listening connection lives outside the pool for the daemon's lifetime.
+        connection.detach()
+        connection = connection.dbapi_connection
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {SLOT_CHANNEL}")
+        self._connection = connection
+        logger.info("Listening for %s notifications", SLOT_CHANNEL)
+
+    def _observe(self, component, value, labels):
+        if self._metrics is not None:
+            self._metrics.observe(component, value, labels)
+
+    def _record_error(self):
+        self._errors += 1
+        if self._metrics is not None:
+            self._metrics.add("reconcile-errors", self._errors)
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def _notified_slot_ids(self, timeout):
+        if select.select([self._connection], [], [], max(timeout, 0)) == ([], [], []):
+            return set()
+        self._connection.poll()
+        slot_ids = {int(notify.payload) for notify in self._connection.notifies}
+        self._connection.notifies.clear()
+        return slot_ids
+
+    def _schedule(self, slot_ids=None):
+        from lib.database import db_session
+        from lib.models import KuberState, Slot
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        query = (
+            sql_select(Slot.id, Slot.time, Slot.end, Slot.kuber_state)
+            .where(Slot.email != "")
+            .where(or_(Slot.kuber_state == None, Slot.kuber_state != KuberState.Removed))  # noqa: E711
+        )
+        if slot_ids is not None:
+            query = query.where(Slot.id.in_(slot_ids))
+        else:
+            query = query.where(Slot.end >= now - self._slack_time)
+
+        with db_session() as session:
+            for slot_id, begin, end, kuber_state in session.execute(query):
+                if kuber_state == KuberState.Empty:
+                    self._add_timer(begin - self._prep_time, slot_id, now)
+                self._add_timer(end + self._slack_time, slot_id, now)
+
+    def _add_timer(self, when, slot_id, now):
+        # Whatever is already due was handled by the reconcile that led here.
+        if when <= now or (when, slot_id) in self._scheduled:
+            return
+        self._scheduled.add((when, slot_id))
+        heapq.heappush(self._timers, (when, slot_id))
+
+    def _due_slot_ids(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        slot_ids = set()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)
+            self._scheduled.discard(timer)
+            slot_ids.add(timer[1])
+        return slot_ids
+
+    def _seconds_to_next_timer(self):
+        if not self._timers:
+            return float("inf")
+        return (self._timers[0][0] - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+    def _waiting_slot_ids(self):
+        from lib.database import db_session
+        from lib.models import KuberState, Slot
+
+        with db_session() as session:
+            return set(session.scalars(sql_select(Slot.id).where(Slot.kuber_state.in_([KuberState.Published, KuberState.Removing]))))
+
+    def _run_reconcile(self, slot_ids):
+        if not slot_ids:
+            return
+        logger.info("Reconciling slots %s", sorted(slot_ids))
+        started = time.monotonic()
+        try:
+            self._reconcile(slot_ids)
+        except Exception:
+            logger.exception("Failed to reconcile slots %s", sorted(slot_ids))
+            self._record_error()
+        self._schedule(slot_ids)
+        self._observe("reconcile-duration", time.monotonic() - started, {"pass": "slots"})
+        self._observe("reconcile-batch-size", len(slot_ids), {"pass": "slots"})
+
+    def _run_full_scan(self):
+        logger.info("Running full scan")
+        started = time.monotonic()
+        try:
+            self._full_scan()
+        except Exception:
+            logger.exception("Full scan failed")
+            self._record_error()
+        self._schedule()
+        self._observe("reconcile-duration", time.monotonic() - started, {"pass": "full-scan"})
+        if self._metrics is not None:
+            self._metrics.add("timers", len(self._timers))
+
+    def run(self):
+        next_full_scan = 0
+        next_check = 0
+        while True:
+            try:
+                if self._connection is None:
+                    self._listen()
+                    next_full_scan = 0
+
+                now = time.monotonic()
+                if now >= next_full_scan:
+                    self._run_full_scan()
+                    next_full_scan = now + self._full_scan_interval
+                    next_check = now + self._check_interval
+                elif now >= next_check:
+                    self._run_reconcile(self._waiting_slot_ids())
+                    next_check = now + self._check_interval
+
+                timeout = min(self._seconds_to_next_timer(), next_full_scan - time.monotonic(), next_check - time.monotonic())
+                self._run_reconcile(self._notified_slot_ids(timeout) | self._due_slot_ids())
+            except Exception:
+                logger.exception("Reconciler loop failed, reconnecting")
+                self._close()
+                time.sleep(RECONNECT_DELAY_SECONDS)
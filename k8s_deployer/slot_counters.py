@@ -0,0 +1,110 @@
+import datetime
+from dataclasses import dataclass, field
+from typing import Callable
+
+from sqlalchemy import and_, func, select
+
+from .stub import MONITORING_DEFAULT_DEMAND_MARGIN, MONITORING_DEFAULT_PING_MARGIN, base_logger
+
+logger = base_logger.getChild("slot_counters")
+
+BOOKED_DAYS_AHEAD = 7
+
+
+@dataclass
+class Counter:
+    key: str
+    component: str
+    # (Slot, now) -> SQL condition selecting the counted rows.
+    condition: Callable
+    labels: dict = field(default_factory=dict)
+
+
+def _booked(slot):
+    return slot.email != ""
+
+
+def declare_counters():
+    from lib.models import KuberState, Locale
+
+    day = datetime.timedelta(days=1)
+    counters = [
+        Counter(
+            "demand",
+            "demand",
+            lambda slot, now: and_(_booked(slot), slot.time <= now + datetime.timedelta(minutes=MONITORING_DEFAULT_DEMAND_MARGIN), slot.end >= now),
+        ),
+        Counter("promised", "promised", lambda slot, now: and_(_booked(slot), slot.time <= now, slot.end >= now)),
+        Counter("opened_1d", "opened", lambda slot, now: and_(slot.enabled, slot.time > now, slot.time <= now + day), {"interval": "1d"}),
+        Counter("opened_4d", "opened", lambda slot, now: and_(slot.enabled, slot.time > now, slot.time <= now + 4 * day), {"interval": "4d"}),
+        Counter("opened_after_4d", "opened", lambda slot, now: and_(slot.enabled, slot.time > now + 4 * day), {"interval": "afeter_4d"}),
+    ]
+    counters.extend(
+        Counter(f"state_{state.value}", "slots", lambda slot, now, state=state: slot.kuber_state == state, {"kuber-state": state.value})
+        for state in KuberState
+    )
+    counters.extend(
+        Counter(
+            f"locale_{locale.value}",
+            "booked",
+            lambda slot, now, locale=locale: and_(_booked(slot), slot.end >= now, slot.locale == locale),
+            {"locale": locale.value},
+        )
+        for locale in Locale
+    )
+    counters.extend(
+        Counter(
+            f"day_{offset}",
+            "booked",
+            lambda slot, now, offset=offset: and_(_booked(slot), slot.time >= now + offset * day, slot.time < now + (offset + 1) * day),
+            {"day": f"+{offset}d"},
+        )
+        for offset in range(BOOKED_DAYS_AHEAD)
+    )
+    return counters
+
+
+@dataclass
+class SlotCounts:
+    now: datetime.datetime
+    values: dict
+    counters: list
+    # (namespace, password) of the slots liveness probes.
+    demanded_slots: list
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def add_to(self, metrics, keys):
+        for counter in self.counters:
+            if counter.key in keys:
+                metrics.add(counter.component, self.values[counter.key], counter.labels)
+
+
+def count_slots(now=None, counters=None):
+    from lib.database import db_session
+    from lib.models import Slot
+
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    if counters is None:
+        counters = declare_counters()
+
+    demanded = and_(_booked(Slot), Slot.time <= now + datetime.timedelta(minutes=MONITORING_DEFAULT_PING_MARGIN), Slot.end >= now)
+    # One statement sees one snapshot, so all counters agree with each other.
+    query = select(
+        *[func.count().filter(counter.condition(Slot, now)).label(f"c{index}") for index, counter in enumerate(counters)],
+        func.json_agg(func.json_build_array(Slot.namespace, Slot.password)).filter(demanded).label("demanded"),
+    ).select_from(Slot)
+
+    with db_session() as session:
+        row = session.execute(query).one()
+
+    counts = SlotCounts(
+        now=now,
+        values={counter.key: row[index] for index, counter in enumerate(counters)},
+        counters=counters,
+        demanded_slots=[tuple(slot) for slot in row.demanded or []],
+    )
+    logger.info("Slot counters: %s", counts.values)
+    return counts
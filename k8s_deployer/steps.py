@@ -1,54 +1,29 @@
-import os
-import tempfile
-from pprint import pformat
+import time
 
 import click
 import yaml
 from kubernetes import client
-from kubernetes.utils import create_from_yaml
 
+from lib.logs import Pretty
+
+from .apply import DEFAULT_APPLY_WORKERS, ApplyError, apply_manifests
+from .bundle import YamlLoader, get_bundle, render_manifests
 from .datalens_connection import make_datalens_cypher
+from .discovery import create_from_spec
 from .image_config import images
+from .informer import get_informers
+from .metrics import get_process_metrics
 from .stub import DEMO_CONTOUR_FLAG
 from .stub import base_logger as logger
-from .stub import jinja_env, setup_k8s_config
-
-plural_makers = [
-    lambda kind: kind.lower(),
-    lambda kind: kind.lower() + "s",
-    lambda kind: kind.lower() + "es",
-]
+from .stub import get_jinja_env, setup_k8s_config
 
 
 def parse_spec_from_file(file, **kwargs):
-    text = jinja_env.get_template(file).render(**kwargs)
-    spec = yaml.load(text, yaml.FullLoader)
+    text = get_jinja_env().get_template(file).render(**kwargs)
+    spec = yaml.load(text, YamlLoader)
     return spec
 
 
-def create_custom_object_from_spec(namespace, body):
-    setup_k8s_config()
-    customObjectApi = client.CustomObjectsApi()
-    group, version = body["apiVersion"].split("/")
-    for plural_maker in plural_makers:
-        plular = plural_maker(body["kind"])
-        try:
-            logger.info("Attempting plural: %s", plular)
-            custom_object = customObjectApi.create_namespaced_custom_object(
-                group,
-                version,
-                namespace,
-                plular,
-                body,
-            )
-            logger.info(f"Successfully applied custom object {plular}")
-            return custom_object
-        except client.exceptions.ApiException as e:
-            logger.exception(f"Error while creating custom object {plular}")
-            exception = e
-    raise exception
-
-
 def create_object(
     creator,
     filename,
@@ -80,16 +55,26 @@ def steps():
 @steps.command()
 @click.option("-n", "--name", required=True)
 @click.option("--manual", default=False, is_flag=True)
+@click.option("--exist-ok", default=False, is_flag=True, help="Carry on with a namespace created before")
+@click.option("--label", "labels", multiple=True, help="Extra namespace label, KEY=VALUE")
 @click.pass_context
-def create_namespace(ctx, name, manual):
+def create_namespace(ctx, name, manual, exist_ok, labels):
     setup_k8s_config()
-    api_response = create_object(
-        client.CoreV1Api().create_namespace,
-        "namespace.yaml",
-        name=name,
-        contour="manual" if manual else ctx.obj[DEMO_CONTOUR_FLAG],
-    )
-    logger.info(pformat(api_response))
+    try:
+        api_response = create_object(
+            client.CoreV1Api().create_namespace,
+            "namespace.yaml",
+            name=name,
+            contour="manual" if manual else ctx.obj[DEMO_CONTOUR_FLAG],
+            labels=dict(label.split("=", 1) for label in labels),
+        )
+    except client.exceptions.ApiException as e:
+        if exist_ok and e.status == 409:
+            logger.info("Namespace %s already exists", name)
+            return
+        raise
+    logger.info("Created namespace %s", name)
+    logger.debug("%s", Pretty(api_response))
 
 
 @steps.command()
@@ -98,22 +83,28 @@ def remove(namespace):
     setup_k8s_config()
     k8s = client.CoreV1Api()
 
-    if namespace not in [ns.metadata.name for ns in k8s.list_namespace().items]:
-        logger.info("Namespace does not exist")
-        return
-
-    api_response = k8s.delete_namespace(namespace)
-    logger.info(pformat(api_response))
+    try:
+        api_response = k8s.delete_namespace(namespace)
+    except client.exceptions.ApiException as e:
+        if e.status == 404:
+            logger.info("Namespace does not exist")
+            return False
+        raise
+    logger.info("Requested removal of namespace %s", namespace)
+    logger.debug("%s", Pretty(api_response))
+    return True
 
 
 class NamespaceCreator:
-    def __init__(self, ctx, name, manual):
+    def __init__(self, ctx, name, manual, resume=False, labels=()):
         self.ctx = ctx
         self.name = name
         self.manual = manual
+        self.resume = resume
+        self.labels = labels
 
     def __enter__(self):
-        self.ctx.invoke(create_namespace, name=self.name, manual=self.manual)
+        self.ctx.invoke(create_namespace, name=self.name, manual=self.manual, exist_ok=self.resume, labels=self.labels)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is not None:
@@ -122,8 +113,9 @@ class NamespaceCreator:
 
 
 def list_templates():
-    return jinja_env.list_templates(
+    return get_jinja_env().list_templates(
         filter_func=lambda name: name.endswith(".yaml")
+        and not name.startswith("pool/")
         and name
         not in {
             "namespace.yaml",
@@ -132,11 +124,60 @@ def list_templates():
     )
 
 
-def list_template_files(dir, priority):
-    paths = []
-    for root, _, filenames in os.walk(dir):
-        paths.extend((root, filename) for filename in filenames)
-    return [os.path.join(*parts) for parts in sorted(paths, key=lambda parts: priority.get(parts[-1], 0))]
+def namespace_ready(namespace):
+    upload_demo_data = False
+    rotation_pending = False
+    rotation_done = False
+    ready = True
+    informers = get_informers()
+    cluster = informers.ytsaurus.get("ytdemo", namespace=namespace)
+    cluster_state = cluster.get("status", {}).get("state") if cluster is not None else None
+    if cluster_state != "Running":
+        logger.info("Ytsaurus ytdemo is in state %s", cluster_state)
+        ready = False
+    for pod in informers.pods.list(namespace=namespace):
+        if pod.metadata.owner_references[0].kind in ("StatefulSet", "ReplicaSet") and pod.status.phase != "Running":
+            logger.info("Pod %s is in state %s", pod.metadata.name, pod.status.phase)
+            ready = False
+        if pod.metadata.owner_references[0].kind == "Job" and pod.metadata.name.startswith("upload-demo-data") and pod.status.phase == "Succeeded":
+            upload_demo_data = True
+        if pod.metadata.owner_references[0].kind == "Job" and pod.metadata.name.startswith("rotate-credentials"):
+            rotation_pending = True
+            rotation_done = rotation_done or pod.status.phase == "Succeeded"
+
+    if not upload_demo_data:
+        logger.info("Job upload-demo-data has not Succeeded")
+        ready = False
+    if rotation_pending and not rotation_done:
+        logger.info("Job rotate-credentials has not Succeeded")
+        ready = False
+    return ready
+
+
+def apply_manifest(k8s_client, namespace, manifest, exist_ok=False):
+    try:
+        return create_from_spec(k8s_client, namespace, manifest.body)
+    except client.exceptions.ApiException as e:
+        if exist_ok and e.status == 409:
+            logger.info("%s already exists", manifest)
+            return None
+        raise
+
+
+def log_apply_report(results):
+    for result in sorted(results, key=lambda result: result.elapsed, reverse=True):
+        logger.info(
+            "%s %s in %.3fs%s",
+            "Applied" if result.ok else "Failed",
+            result.manifest,
+            result.elapsed,
+            "" if result.ok else f": {result.error}",
+        )
+
+
+def observe_apply_results(metrics, results):
+    for result in results:
+        metrics.observe("apply-latency", result.elapsed, {"kind": result.manifest.kind, "result": "ok" if result.ok else "error"})
 
 
 @steps.command()
@@ -144,49 +185,81 @@ def list_template_files(dir, priority):
 @click.option("-p", "--password", required=True)
 @click.option("--persistent", type=bool)
 @click.option("--manual", default=False, is_flag=True)
+@click.option("--workers", type=int, default=DEFAULT_APPLY_WORKERS)
+@click.option("--bundle-cache-dir", default=None, help="Keep compiled manifest bundles on disk here (default: $YT_DEMO_BUNDLE_CACHE_DIR)")
+@click.option("--resume", default=False, is_flag=True, help="Finish a deploy that was interrupted, keeping what it created")
+@click.option("--label", "labels", multiple=True, help="Extra namespace label, KEY=VALUE")
 @click.pass_context
-def create(ctx, name, password, manual, persistent):
-    priority = {
-        "secret.yaml": 1000,
-    }
-
+def create(ctx, name, password, manual, persistent, workers, bundle_cache_dir, resume, labels):
     setup_k8s_config()
     k8s_client = client.ApiClient()
 
-    with NamespaceCreator(ctx, name, manual):
-        with tempfile.TemporaryDirectory() as dir:
-            for template in list_templates():
-                os.makedirs(os.path.join(dir, os.path.dirname(template)), exist_ok=True)
-                with open(os.path.join(dir, template), "w") as f:
-                    f.write(
-                        jinja_env.get_template(template).render(
-                            namespace=name,
-                            password=password,
-                            persistent=persistent,
-                            images=images,
-                            str=str,
-                            datalens_cypher_text=make_datalens_cypher(password),
-                        )
-                    )
-
-            for file in list_template_files(dir, priority):
-                logger.info("Applying %s", file)
-
-                try:
-                    create_from_yaml(
-                        k8s_client,
-                        file,
-                        verbose=True,
-                        namespace=name,
-                    )
-                except Exception:
-                    logger.exception("Will attempt to create as custom resource for %s instead", file)
-                    with open(file, "r") as text:
-                        create_custom_object_from_spec(namespace=name, body=yaml.load(text, yaml.FullLoader))
-                logger.info("Successfully applied %s", file)
+    metrics = get_process_metrics()
+    started = time.monotonic()
+
+    with NamespaceCreator(ctx, name, manual, resume, labels):
+        # render-duration is observed per template by the bundle itself.
+        bundle = get_bundle(list_templates(), persistent, cache_dir=bundle_cache_dir)
+        manifests = bundle.materialize(
+            namespace=name,
+            password=password,
+            datalens_cypher_text=make_datalens_cypher(password),
+        )
+
+        try:
+            results = apply_manifests(
+                manifests,
+                lambda manifest: apply_manifest(k8s_client, name, manifest, exist_ok=resume),
+                workers=workers,
+            )
+        except ApplyError as e:
+            log_apply_report(e.results)
+            observe_apply_results(metrics, e.results)
+            raise
+        log_apply_report(results)
+        observe_apply_results(metrics, results)
+    metrics.observe("create-duration", time.monotonic() - started)
     logger.info("Everything is OK, eta 3min")
+    return results
 
 
 @steps.command("list-templates")
 def list_templates_command():
     click.echo("\n".join(list_templates()))
+
+
+@steps.command("benchmark-render")
+@click.option("--iterations", type=int, default=10)
+@click.option("--persistent", type=bool)
+def benchmark_render_command(iterations, persistent):
+    def render_directly(namespace, password):
+        return render_manifests(
+            list_templates(),
+            namespace=namespace,
+            password=password,
+            persistent=persistent,
+            images=images,
+            str=str,
+            datalens_cypher_text=make_datalens_cypher(password),
+        )
+
+    def render_from_bundle(namespace, password):
+        return get_bundle(list_templates(), persistent, cache_dir="").materialize(
+            namespace=namespace,
+            password=password,
+            datalens_cypher_text=make_datalens_cypher(password),
+        )
+
+    def measure(render):
+        started = time.perf_counter()
+        for i in range(iterations):
+            render(f"bench{i:04d}", f"password{i}")
+        return (time.perf_counter() - started) / iterations
+
+    started = time.perf_counter()
+    render_from_bundle("bench", "password")
+    compile_time = time.perf_counter() - started
+
+    click.echo(f"render + parse per deploy: {measure(render_directly) * 1000:.1f} ms")
+    click.echo(f"bundle compile (once):     {compile_time * 1000:.1f} ms")
+    click.echo(f"bundle patch per deploy:   {measure(render_from_bundle) * 1000:.1f} ms")
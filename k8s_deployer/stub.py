@@ -1,22 +1,14 @@
 import base64
+import functools
 import logging
 from pathlib import Path
 
-import jinja2
 from kubernetes import client, config
 
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-if root_logger.hasHandlers():
-    root_handler = root_logger.handlers[0]
-else:
-    root_handler = logging.StreamHandler()
-    root_logger.addHandler(root_handler)
-root_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s"))
-base_logger = logging.getLogger("yt-demo")
+from lib.logs import configure_logging
 
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(Path(__file__).with_name("config_templates")))
-jinja_env.filters["b64encode"] = base64.b64encode
+configure_logging()
+base_logger = logging.getLogger("yt-demo")
 
 DEMO_CONTOUR_FLAG = "yt-demo-contour"
 MONITORING_DEFAULT_DEMAND_MARGIN = 5
@@ -25,6 +17,22 @@ MONITORING_DEFAULT_PING_MARGIN = 6
 k8s_config_set = False
 
 
+@functools.lru_cache(maxsize=None)
+def get_jinja_env():
+    # Built on first render: entrypoints that never touch templates do not pay for jinja.
+    import jinja2
+
+    jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(Path(__file__).with_name("config_templates")))
+    jinja_env.filters["b64encode"] = base64.b64encode
+    return jinja_env
+
+
+def __getattr__(name):
+    if name == "jinja_env":
+        return get_jinja_env()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def setup_k8s_config(configuration=None):
     global k8s_config_set
     if configuration is not None:
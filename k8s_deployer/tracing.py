@@ -0,0 +1,95 @@
+import json
+
+from .informer import get_informers
+from .stub import base_logger
+
+logger = base_logger.getChild("tracing")
+
+
+def _seconds(begin, end):
+    if begin is None or end is None:
+        return None
+    return (end - begin).total_seconds()
+
+
+def _condition_time(pod, condition_type):
+    for condition in pod.status.conditions or []:
+        if condition.type == condition_type:
+            return condition.last_transition_time
+    return None
+
+
+def _containers_started(pod):
+    started = [status.state.running.started_at for status in pod.status.container_statuses or [] if status.state and status.state.running]
+    return max(started) if started else None
+
+
+def namespace_timeline(namespace):
+    # Where the deploy of a namespace spent its time, as far as kubernetes remembers it:
+    # operator = namespace created -> first workload pod created,
+    # pod-startup = slowest pod from scheduled to all containers running (mostly image pulls),
+    # demo-data = the upload-demo-data job from start to completion.
+    informers = get_informers()
+    timeline = {"pool": False}
+
+    namespace_object = informers.namespaces.get(namespace)
+    if namespace_object is not None:
+        timeline["pool"] = "yt-demo-pool" in (namespace_object.metadata.labels or {})
+        created = namespace_object.metadata.creation_timestamp
+    else:
+        created = None
+
+    workload_pods = [
+        pod
+        for pod in informers.pods.list(namespace=namespace)
+        if pod.metadata.owner_references and pod.metadata.owner_references[0].kind in ("StatefulSet", "ReplicaSet")
+    ]
+    first_pod = min((pod.metadata.creation_timestamp for pod in workload_pods), default=None)
+    startups = [_seconds(_condition_time(pod, "PodScheduled"), _containers_started(pod)) for pod in workload_pods]
+    startups = [startup for startup in startups if startup is not None]
+
+    job = informers.jobs.get("upload-demo-data", namespace=namespace)
+
+    timeline["phases"] = {
+        "operator": _seconds(created, first_pod),
+        "pod-startup": max(startups) if startups else None,
+        "demo-data": _seconds(job.status.start_time, job.status.completion_time) if job is not None else None,
+    }
+    return timeline
+
+
+def slot_trace(slot, timeline=None):
+    trace = {
+        "slot": slot.id,
+        "namespace": slot.namespace,
+        "time": slot.time.isoformat(),
+        "booked_at": slot.booked_at.isoformat() if slot.booked_at else None,
+        "deploy_started_at": slot.deploy_started_at.isoformat() if slot.deploy_started_at else None,
+        "published_at": slot.published_at.isoformat() if slot.published_at else None,
+        "running_at": slot.running_at.isoformat() if slot.running_at else None,
+        "time_to_published": _seconds(slot.deploy_started_at, slot.published_at),
+        "time_to_running": _seconds(slot.deploy_started_at, slot.running_at),
+        # Negative when the cluster was ready only after the slot had started.
+        "headroom": _seconds(slot.running_at, slot.time),
+    }
+    if timeline is not None:
+        trace.update(timeline)
+    return trace
+
+
+def log_slot_trace(trace):
+    logger.info("Slot trace: %s", json.dumps(trace))
+
+
+def observe_slot_trace(metrics, trace):
+    labels = {"source": "pool" if trace.get("pool") else "fresh"}
+    for component in ("time-to-published", "time-to-running"):
+        value = trace[component.replace("-", "_")]
+        if value is not None:
+            metrics.observe(component, value, labels)
+    if trace["headroom"] is not None:
+        metrics.observe("late-start", max(-trace["headroom"], 0), labels)
+    if not trace.get("pool"):
+        for phase, value in trace.get("phases", {}).items():
+            if value is not None:
+                metrics.observe("deploy-phase-duration", value, {"phase": phase})
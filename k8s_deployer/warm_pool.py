@@ -0,0 +1,223 @@
+import base64
+import datetime
+import uuid
+
+from kubernetes import client
+
+from .bundle import render_manifests
+from .datalens_connection import make_datalens_cypher
+from .discovery import create_from_spec
+from .image_config import images
+from .informer import get_informers
+from .steps import create, namespace_ready, remove
+from .stub import DEMO_CONTOUR_FLAG, base_logger, setup_k8s_config
+
+logger = base_logger.getChild("warm_pool")
+
+POOL_LABEL = "yt-demo-pool"
+POOL_SLOT_LABEL = "yt-demo-slot"
+POOL_NAMESPACE_PREFIX = "pool-"
+
+
+class PoolState:
+    Warming = "warming"
+    Free = "free"
+    Claimed = "claimed"
+    Removing = "removing"
+
+
+def _label_selector(obj, states):
+    selector = [f"{POOL_LABEL} in ({','.join(states)})"]
+    if obj[DEMO_CONTOUR_FLAG] is not None:
+        selector.append(f"{DEMO_CONTOUR_FLAG}={obj[DEMO_CONTOUR_FLAG]}")
+    return ",".join(selector)
+
+
+def list_pool_namespaces(obj, states=(PoolState.Warming, PoolState.Free)):
+    setup_k8s_config()
+    return client.CoreV1Api().list_namespace(label_selector=_label_selector(obj, states)).items
+
+
+def pool_occupancy(obj):
+    occupancy = {state: 0 for state in (PoolState.Warming, PoolState.Free, PoolState.Claimed)}
+    for namespace in get_informers().namespaces.list():
+        labels = namespace.metadata.labels or {}
+        if obj[DEMO_CONTOUR_FLAG] is not None and labels.get(DEMO_CONTOUR_FLAG) != obj[DEMO_CONTOUR_FLAG]:
+            continue
+        if labels.get(POOL_LABEL) in occupancy:
+            occupancy[labels[POOL_LABEL]] += 1
+    return occupancy
+
+
+def _set_pool_state(k8s, namespace, state, resource_version=None, slot_namespace=None):
+    metadata = {"labels": {POOL_LABEL: state}}
+    if slot_namespace is not None:
+        metadata["labels"][POOL_SLOT_LABEL] = slot_namespace
+    if resource_version is not None:
+        # Makes the patch fail with 409 if someone relabelled the namespace first.
+        metadata["resourceVersion"] = resource_version
+    return k8s.patch_namespace(namespace, {"metadata": metadata})
+
+
+def deploy_pool_cluster(ctx):
+    name = POOL_NAMESPACE_PREFIX + uuid.uuid4().hex[:8]
+    logger.info("Deploying pool cluster %s", name)
+    # Labelled from the start: a concurrent fill-pool counts it, and a deploy that crashes
+    # leaves a pool namespace behind, not an unlabelled one.
+    ctx.invoke(create, name=name, password=uuid.uuid4().hex, labels=(f"{POOL_LABEL}={PoolState.Warming}",))
+    return name
+
+
+def _mark_for_removal(k8s, namespace):
+    # Relabelled first, the same way a claim does, so that a cluster claimed meanwhile is not removed.
+    name = namespace.metadata.name
+    try:
+        _set_pool_state(k8s, name, PoolState.Removing, resource_version=namespace.metadata.resource_version)
+    except client.exceptions.ApiException as e:
+        if e.status == 409:
+            logger.info("Pool cluster %s was claimed concurrently, keeping it", name)
+            return False
+        raise
+    return True
+
+
+def fill_pool(ctx, size):
+    setup_k8s_config()
+    k8s = client.CoreV1Api()
+
+    unclaimed = []
+    removing = []
+    for namespace in list_pool_namespaces(ctx.obj, (PoolState.Warming, PoolState.Free, PoolState.Removing)):
+        name = namespace.metadata.name
+        state = namespace.metadata.labels[POOL_LABEL]
+        if state == PoolState.Removing:
+            # Relabelled by a fill-pool that failed before its removal was requested.
+            if namespace.status.phase != "Terminating":
+                removing.append(name)
+            continue
+        if state == PoolState.Warming and namespace_ready(name):
+            logger.info("Pool cluster %s is ready", name)
+            namespace = _set_pool_state(k8s, name, PoolState.Free, resource_version=namespace.metadata.resource_version)
+        unclaimed.append(namespace)
+
+    logger.info("Pool size: %s, target: %s", len(unclaimed), size)
+    removing.extend(namespace.metadata.name for namespace in unclaimed[size:] if _mark_for_removal(k8s, namespace))
+    for name in removing:
+        ctx.invoke(remove, namespace=name)
+    for _ in range(size - len(unclaimed)):
+        deploy_pool_cluster(ctx)
+
+
+def _read_password(k8s, namespace):
+    secret = k8s.read_namespaced_secret("ytadminsec", namespace)
+    return base64.b64decode(secret.data["password"]).decode()
+
+
+def _restart(api, name, namespace, kind):
+    restarted_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    patch = {"spec": {"template": {"metadata": {"annotations": {"kubectl.kubernetes.io/restartedAt": restarted_at}}}}}
+    getattr(api, f"patch_namespaced_{kind}")(name, namespace, patch)
+
+
+def _add_slot_hostnames(namespace, slot_namespace):
+    custom = client.CustomObjectsApi()
+    group, version, plural = "gateway.networking.k8s.io", "v1alpha2", "httproutes"
+    for route in custom.list_namespaced_custom_object(group, version, namespace, plural)["items"]:
+        hostnames = route["spec"].get("hostnames", [])
+        aliases = [hostname.replace(f"-{namespace}.", f"-{slot_namespace}.") for hostname in hostnames]
+        custom.patch_namespaced_custom_object(
+            group,
+            version,
+            namespace,
+            plural,
+            route["metadata"]["name"],
+            {"spec": {"hostnames": list(dict.fromkeys(hostnames + aliases))}},
+        )
+
+
+def rotate_credentials(namespace, slot_namespace, password, resume=False):
+    setup_k8s_config()
+    k8s = client.CoreV1Api()
+    # ytadminsec is patched only after everything that needed the old password, so a resumed
+    # rotation still finds it there.
+    old_password = _read_password(k8s, namespace)
+
+    # The cluster itself learns the new credentials from this job; the patches below
+    # make everything that reads them from secrets pick them up as well.
+    api_client = client.ApiClient()
+    for manifest in render_manifests(
+        ["pool/rotate-credentials.yaml"],
+        namespace=namespace,
+        old_password=old_password,
+        password=password,
+        images=images,
+        str=str,
+        datalens_cypher_text=make_datalens_cypher(password),
+    ):
+        try:
+            create_from_spec(api_client, namespace, manifest.body)
+        except client.exceptions.ApiException as e:
+            if not (resume and e.status == 409):
+                raise
+            logger.info("%s of %s already exists", manifest, namespace)
+
+    k8s.patch_namespaced_secret("grafana", namespace, {"stringData": {"admin-password": password}})
+    grafana_config = k8s.read_namespaced_config_map("grafana", namespace)
+    k8s.patch_namespaced_config_map(
+        "grafana",
+        namespace,
+        {"data": {key: value.replace(old_password, password) for key, value in grafana_config.data.items()}},
+    )
+    k8s.patch_namespaced_secret("ytadminsec", namespace, {"stringData": {"password": password, "token": password}})
+
+    _add_slot_hostnames(namespace, slot_namespace)
+
+    apps = client.AppsV1Api()
+    _restart(apps, "jupyterlab", namespace, "stateful_set")
+    _restart(apps, "grafana", namespace, "deployment")
+
+
+def find_claimed_pool_cluster(obj, slot_namespace):
+    setup_k8s_config()
+    selector = f"{_label_selector(obj, (PoolState.Claimed,))},{POOL_SLOT_LABEL}={slot_namespace}"
+    claimed = client.CoreV1Api().list_namespace(label_selector=selector).items
+    return claimed[0].metadata.name if claimed else None
+
+
+def _claim_free_pool_cluster(k8s, obj, slot_namespace):
+    for namespace in list_pool_namespaces(obj, (PoolState.Free,)):
+        name = namespace.metadata.name
+        try:
+            _set_pool_state(k8s, name, PoolState.Claimed, resource_version=namespace.metadata.resource_version, slot_namespace=slot_namespace)
+        except client.exceptions.ApiException as e:
+            if e.status == 409:
+                logger.info("Pool cluster %s was claimed concurrently", name)
+                continue
+            raise
+        logger.info("Claimed pool cluster %s for %s", name, slot_namespace)
+        return name
+    return None
+
+
+def claim_pool_cluster(obj, slot_namespace, password, resume=False):
+    # Resuming a deploy that was interrupted finishes the pool cluster it had claimed, if
+    # any, instead of claiming another one and leaking the first.
+    setup_k8s_config()
+    k8s = client.CoreV1Api()
+
+    name = find_claimed_pool_cluster(obj, slot_namespace) if resume else None
+    if name is not None:
+        logger.info("Resuming pool cluster %s claimed for %s", name, slot_namespace)
+    else:
+        name = _claim_free_pool_cluster(k8s, obj, slot_namespace)
+    if name is None:
+        logger.info("No free pool cluster for %s", slot_namespace)
+        return None
+    try:
+        rotate_credentials(name, slot_namespace, password, resume=resume)
+    except Exception:
+        # A half-rotated cluster must not be handed out again.
+        logger.exception("Failed to rotate credentials of %s, removing it", name)
+        k8s.delete_namespace(name)
+        raise
+    return name
@@ -1,44 +1,142 @@
-import logging
 import os
+import re
+import threading
+import time
 
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, column, create_engine, event, text
+from sqlalchemy.exc import DisconnectionError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-logging.getLogger("sqlalchemy.engine").setLevel(logging.DEBUG)
+# The engine is created on first use, so importing models (and every cloud function that
+# does) costs no connection setup, and a missing DB_* variable only fails the code that
+# actually talks to the database. It lives as long as the process, so warm function
+# invocations reuse its connections.
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
 
-try:
+# Per process. Behind a pooler (PgBouncer, Odyssey) keep (size + overflow) * instances
+# below its server connection limit; a function instance serves one request at a time.
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_MAX_OVERFLOW = 5
+DEFAULT_POOL_RECYCLE_SECONDS = 1800
+# Connections idle for longer are pinged on checkout; busy ones go straight to work.
+DEFAULT_PING_AFTER_IDLE_SECONDS = 30
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 5
 
-    engine = create_engine(
-        "postgresql://{}:{}@{}:{}/{}".format(
-            os.environ["DB_USER"],
-            os.environ["DB_PASS"],
-            os.environ["DB_HOST"],
-            os.environ["DB_PORT"],
-            os.environ["DB_NAME"],
-        ),
-        pool_pre_ping=True,
-    )
 
-    db_session = scoped_session(
-        sessionmaker(
-            autocommit=False,
-            autoflush=False,
-            bind=engine,
-        )
+def _ping_idle_connections(engine, ping_after_idle):
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        connection_record.info["checked_in_at"] = time.monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_in_at = connection_record.info.get("checked_in_at")
+        if checked_in_at is None or time.monotonic() - checked_in_at < ping_after_idle:
+            return
+        # On DisconnectionError the pool discards the connection and checks out a fresh one.
+        try:
+            alive = engine.dialect.do_ping(dbapi_connection)
+        except Exception as e:
+            raise DisconnectionError(f"Ping failed: {e}")
+        if not alive:
+            raise DisconnectionError(f"Connection idle for {time.monotonic() - checked_in_at:.0f}s is gone")
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_engine(
+                    "postgresql://{}:{}@{}:{}/{}".format(
+                        os.environ["DB_USER"],
+                        os.environ["DB_PASS"],
+                        os.environ["DB_HOST"],
+                        os.environ["DB_PORT"],
+                        os.environ["DB_NAME"],
+                    ),
+                    pool_size=int(os.environ.get("DB_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                    max_overflow=int(os.environ.get("DB_POOL_MAX_OVERFLOW", DEFAULT_POOL_MAX_OVERFLOW)),
+                    pool_recycle=int(os.environ.get("DB_POOL_RECYCLE_SECONDS", DEFAULT_POOL_RECYCLE_SECONDS)),
+                    pool_use_lifo=True,
+                    connect_args={"connect_timeout": int(os.environ.get("DB_CONNECT_TIMEOUT_SECONDS", DEFAULT_CONNECT_TIMEOUT_SECONDS))},
+                )
+                _ping_idle_connections(engine, float(os.environ.get("DB_PING_AFTER_IDLE_SECONDS", DEFAULT_PING_AFTER_IDLE_SECONDS)))
+                _engine = engine
+    return _engine
+
+
+def _create_session():
+    return _session_factory(bind=get_engine())
+
+
+db_session = scoped_session(_create_session)
+
+Base = declarative_base()
+Base.query = db_session.query_property()
+
+
+def prepared_statements_enabled():
+    # Off by default: a transaction-mode pooler may send EXECUTE to a server connection
+    # that never saw the PREPARE.
+    return os.environ.get("DB_PREPARED_STATEMENTS") == "1"
+
+
+_prepared = {}
+
+
+def _prepare(name, statement, dialect):
+    # PREPARE text with typed $n parameters, and a typed EXECUTE so that binds and
+    # results are processed exactly as for the statement itself.
+    compiled = statement.compile(dialect=dialect)
+    names = []
+
+    def placeholder(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    sql = re.sub(r"%\((\w+)\)s", placeholder, compiled.string).replace("%%", "%")
+    binds = [bindparam(bind_name, type_=compiled.binds[bind_name].type) for bind_name in names]
+    types = ", ".join(dialect.type_compiler.process(bind.type) for bind in binds)
+    arguments = f"({', '.join(f':{bind_name}' for bind_name in names)})" if names else ""
+    execute = (
+        text(f"EXECUTE {name}{arguments}")
+        .bindparams(*binds)
+        .columns(*[column(selected.key, selected.type) for selected in statement.selected_columns])
     )
+    return f"PREPARE {name}({types}) AS {sql}" if names else f"PREPARE {name} AS {sql}", compiled, names, execute
+
 
-    Base = declarative_base()
-    Base.query = db_session.query_property()
-except:  # noqa
+def execute_prepared(session, name, statement, params=None):
+    # For fixed hot statements: Postgres parses and plans them once per connection
+    # instead of on every request.
+    if not prepared_statements_enabled():
+        return session.execute(statement, params)
 
-    def db_session():
-        pass
+    connection = session.connection()
+    if name not in _prepared:
+        _prepared[name] = _prepare(name, statement, connection.dialect)
+    prepare, compiled, names, execute = _prepared[name]
 
-    Base = type
+    # info lives as long as the DBAPI connection, and so does a prepared statement.
+    prepared_here = connection.connection.info.setdefault("prepared_statements", set())
+    if name not in prepared_here:
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(prepare)
+        finally:
+            cursor.close()
+        prepared_here.add(name)
 
+    values = compiled.construct_params(params)
+    return connection.execute(execute, {bind_name: values[bind_name] for bind_name in names})
 
-def init_db():
-    import lib.models  # noqa
 
-    Base.metadata.create_all(bind=engine)
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
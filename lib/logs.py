@@ -0,0 +1,160 @@
+import atexit
+import datetime
+import json
+import logging
+import math
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from pprint import pformat
+
+LOG_LEVEL_ENV = "YT_DEMO_LOG_LEVEL"
+LOG_LEVELS_ENV = "YT_DEMO_LOG_LEVELS"
+LOG_SAMPLING_ENV = "YT_DEMO_LOG_SAMPLING"
+LOG_FORMAT_ENV = "YT_DEMO_LOG_FORMAT"
+SQL_ECHO_ENV = "YT_DEMO_SQL_ECHO"
+
+DEFAULT_LOG_LEVEL = "INFO"
+# Share of records below WARNING that is written, by logger and its children.
+DEFAULT_SAMPLING = {"yt-demo.probes": 0.1}
+TEXT_FORMAT = "[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s"
+# Anything else on a record came from `extra=` and becomes a field of the JSON record.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_queue = None
+_listener = None
+_handlers = []
+
+
+class Pretty:
+    # pformat(obj) for a log argument, computed only if the record is written.
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        data.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    # Lets through an evenly spread `rate` share of the records below WARNING from the
+    # matching loggers; warnings and errors always pass.
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._sources = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _source(self, name):
+        if name not in self._sources:
+            matching = [source for source in self.rates if name == source or name.startswith(source + ".")]
+            self._sources[name] = max(matching, key=len) if matching else None
+        return self._sources[name]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        source = self._source(record.name)
+        if source is None:
+            return True
+        rate = self.rates[source]
+        with self._lock:
+            seen = self._seen[source] = self._seen.get(source, 0) + 1
+        return math.ceil(seen * rate) > math.ceil((seen - 1) * rate)
+
+
+class LazyQueueHandler(QueueHandler):
+    # The stock prepare() formats the message in the logging thread. Here the listener does
+    # it, only the traceback is rendered right away since it refers to live frames.
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _parse_settings(value, convert):
+    # "name=value,name=value"
+    settings = {}
+    for item in (value or "").split(","):
+        name, _, setting = item.partition("=")
+        if name.strip():
+            settings[name.strip()] = convert(setting.strip())
+    return settings
+
+
+def configure_levels():
+    logging.getLogger().setLevel(os.environ.get(LOG_LEVEL_ENV, DEFAULT_LOG_LEVEL).upper())
+    # 1 logs statements, debug also logs result rows.
+    sql_echo = os.environ.get(SQL_ECHO_ENV, "")
+    if sql_echo:
+        logging.getLogger("sqlalchemy.engine").setLevel(logging.DEBUG if sql_echo.lower() == "debug" else logging.INFO)
+    for name, level in _parse_settings(os.environ.get(LOG_LEVELS_ENV), str.upper).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def configure_logging():
+    # Loggers only put records on a queue; a listener thread formats and writes them through
+    # the handlers root had (a function runtime installs its own) or a stderr stream.
+    global _queue, _listener, _handlers
+    configure_levels()
+    if _listener is not None:
+        return
+
+    root = logging.getLogger()
+    _handlers = list(root.handlers) or [logging.StreamHandler()]
+    formatter = logging.Formatter(TEXT_FORMAT) if os.environ.get(LOG_FORMAT_ENV, "json") == "text" else JsonFormatter()
+    for handler in _handlers:
+        handler.setFormatter(formatter)
+        root.removeHandler(handler)
+
+    _queue = queue.Queue()
+    queue_handler = LazyQueueHandler(_queue)
+    queue_handler.addFilter(SamplingFilter({**DEFAULT_SAMPLING, **_parse_settings(os.environ.get(LOG_SAMPLING_ENV), float)}))
+    root.addHandler(queue_handler)
+    _listener = QueueListener(_queue, *_handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def flush_logs():
+    # Waits until everything logged so far is written. A function instance may be frozen as
+    # soon as the invocation returns, so handlers call this before returning.
+    if _listener is not None:
+        _queue.join()
+
+
+def stop_logging():
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, LazyQueueHandler):
+            root.removeHandler(handler)
+    for handler in _handlers:
+        root.addHandler(handler)
@@ -0,0 +1,263 @@
+import logging
+from dataclasses import dataclass
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+from lib.database import Base, get_engine
+
+logger = logging.getLogger(__name__)
+
+# Any constant shared by all migrators: watcher, monitoring and cmd may start together.
+MIGRATION_LOCK_ID = 7301
+SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+)
+"""
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    # SQL strings, or callables taking the connection.
+    steps: list
+
+
+def _create_tables(*names):
+    def step(connection):
+        import lib.models  # noqa
+
+        Base.metadata.create_all(connection, tables=[Base.metadata.tables[name] for name in names])
+
+    return step
+
+
+def _create_index(name, definition):
+    # CONCURRENTLY keeps the table writable meanwhile; if it is interrupted it leaves an
+    # invalid index behind, which IF NOT EXISTS would take for done.
+    def step(connection):
+        valid = connection.execute(text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), dict(name=name)).scalar()
+        if valid is False:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
+
+    return step
+
+
+def _create_slot_all_view(*columns):
+    # Fixed columns, not the model's: the model may have columns that only a later migration adds.
+    def step(connection):
+        from lib.slot_archive import slot_all_view_sql
+
+        connection.execute(text(slot_all_view_sql(columns)))
+
+    return step
+
+
+# Slot columns as of migration 5.
+SLOT_ARCHIVE_COLUMNS = (
+    "id",
+    "time",
+    "end",
+    "enabled",
+    "email",
+    "namespace",
+    "password",
+    "kuber_state",
+    "locale",
+    "company",
+    "booked_at",
+    "deploy_started_at",
+    "published_at",
+    "running_at",
+    "removal_requested_at",
+    "removed_at",
+    "lease_owner",
+    "lease_expires_at",
+)
+
+
+# Steps run outside of a transaction (ALTER TYPE ... ADD VALUE and CREATE INDEX CONCURRENTLY
+# require that), so each must be safe to run again after an interrupted migration. The
+# baseline creates tables from the current models: on a new database later ALTERs find
+# their columns already there and must be written with IF NOT EXISTS.
+MIGRATIONS = [
+    Migration(
+        1,
+        "baseline",
+        [
+            _create_tables("slot", "mail", "slot_version"),
+            "ALTER TYPE kuberstate ADD VALUE IF NOT EXISTS 'Deploying'",
+            "ALTER TYPE kuberstate ADD VALUE IF NOT EXISTS 'Removing'",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS removal_requested_at TIMESTAMP WITHOUT TIME ZONE",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS booked_at TIMESTAMP WITHOUT TIME ZONE",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS deploy_started_at TIMESTAMP WITHOUT TIME ZONE",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS published_at TIMESTAMP WITHOUT TIME ZONE",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS running_at TIMESTAMP WITHOUT TIME ZONE",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS removed_at TIMESTAMP WITHOUT TIME ZONE",
+            # Lets timeslots tell whether its cached availability is still current.
+            "INSERT INTO slot_version (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING",
+            """
+            CREATE OR REPLACE FUNCTION bump_slot_version() RETURNS trigger AS $$
+            BEGIN
+                UPDATE slot_version SET version = version + 1 WHERE id = 1;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS slot_version_bump ON slot",
+            # Per row, so that statements which change nothing (e.g. a lost booking race) do not
+            # queue on the slot_version row lock.
+            """
+            CREATE TRIGGER slot_version_bump AFTER INSERT OR DELETE OR UPDATE OF id, time, enabled ON slot
+            FOR EACH ROW EXECUTE PROCEDURE bump_slot_version()
+            """,
+            "DROP TRIGGER IF EXISTS slot_version_bump_truncate ON slot",
+            "CREATE TRIGGER slot_version_bump_truncate AFTER TRUNCATE ON slot FOR EACH STATEMENT EXECUTE PROCEDURE bump_slot_version()",
+            # Wakes up `db-driven serve` whenever a slot is booked or changes state.
+            """
+            CREATE OR REPLACE FUNCTION notify_slot_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('slot_changed', NEW.id::text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS slot_changed ON slot",
+            """
+            CREATE TRIGGER slot_changed AFTER INSERT OR UPDATE OF email, time, "end", kuber_state ON slot
+            FOR EACH ROW EXECUTE PROCEDURE notify_slot_changed()
+            """,
+        ],
+    ),
+    Migration(
+        2,
+        "hot query indexes",
+        [
+            # Watcher: Empty slots about to start, Published and Removing slots.
+            _create_index("slot_kuber_state_time", "slot (kuber_state, time)"),
+            # timeslots window and slot listings.
+            _create_index("slot_time", "slot (time)"),
+            # remove_expired: slots past their end that are not removed yet.
+            _create_index("slot_end_not_removed", """slot ("end") WHERE kuber_state <> 'Removed'"""),
+            # Mail outbox: unsent mail due by now.
+            _create_index("mail_outbox", "mail (sent, time_to_send)"),
+        ],
+    ),
+    Migration(
+        3,
+        "mail delivery attempts",
+        [
+            "ALTER TABLE mail ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+        ],
+    ),
+    Migration(
+        4,
+        "watcher leases",
+        [
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(100)",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITHOUT TIME ZONE",
+        ],
+    ),
+    # A migration adding a slot column must add it to slot_archive too and run
+    # _create_slot_all_view again with the column added to its list.
+    Migration(
+        5,
+        "slot archive",
+        [
+            "CREATE TABLE IF NOT EXISTS slot_archive (LIKE slot)",
+            "ALTER TABLE slot_archive ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP WITHOUT TIME ZONE",
+            "CREATE UNIQUE INDEX IF NOT EXISTS slot_archive_id ON slot_archive (id)",
+            "CREATE INDEX IF NOT EXISTS slot_archive_time ON slot_archive (time)",
+            _create_slot_all_view(*SLOT_ARCHIVE_COLUMNS),
+        ],
+    ),
+    Migration(
+        6,
+        "slot versions",
+        [
+            # Replaces the slot_version row: every booking updated it and held its lock until
+            # commit, so bookings queued behind each other.
+            "CREATE SEQUENCE IF NOT EXISTS slot_version_seq",
+            "ALTER TABLE slot ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('slot_version_seq')",
+            "ALTER TABLE slot_archive ADD COLUMN IF NOT EXISTS version BIGINT",
+            # The new column goes before archived_at, which CREATE OR REPLACE VIEW cannot do.
+            "DROP VIEW IF EXISTS slot_all",
+            _create_slot_all_view(*SLOT_ARCHIVE_COLUMNS, "version"),
+            """
+            CREATE OR REPLACE FUNCTION next_slot_version() RETURNS trigger AS $$
+            BEGIN
+                NEW.version := nextval('slot_version_seq');
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS slot_version_next ON slot",
+            """
+            CREATE TRIGGER slot_version_next BEFORE UPDATE OF time, enabled ON slot
+            FOR EACH ROW WHEN (OLD.time IS DISTINCT FROM NEW.time OR OLD.enabled IS DISTINCT FROM NEW.enabled)
+            EXECUTE PROCEDURE next_slot_version()
+            """,
+            "DROP TRIGGER IF EXISTS slot_version_bump ON slot",
+            "DROP TRIGGER IF EXISTS slot_version_bump_truncate ON slot",
+            "DROP FUNCTION IF EXISTS bump_slot_version()",
+            "DROP TABLE IF EXISTS slot_version",
+            # timeslots checks its window with an index-only scan.
+            _create_index("slot_time_version", "slot (time) INCLUDE (version)"),
+            "DROP INDEX CONCURRENTLY IF EXISTS slot_time",
+        ],
+    ),
+]
+LATEST_VERSION = max(migration.version for migration in MIGRATIONS)
+
+_up_to_date = False
+
+
+def current_version(connection):
+    try:
+        return connection.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+    except ProgrammingError:
+        return 0
+
+
+def migrate(engine=None):
+    engine = engine or get_engine()
+    applied_now = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:id)"), dict(id=MIGRATION_LOCK_ID))
+        try:
+            connection.execute(text(SCHEMA_VERSION_TABLE))
+            applied = set(connection.execute(text("SELECT version FROM schema_version")).scalars())
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                logger.info("Applying migration %s: %s", migration.version, migration.name)
+                for step in migration.steps:
+                    if callable(step):
+                        step(connection)
+                    else:
+                        connection.execute(text(step))
+                connection.execute(
+                    text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+                    dict(version=migration.version, name=migration.name),
+                )
+                applied_now.append(migration)
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:id)"), dict(id=MIGRATION_LOCK_ID))
+    return applied_now
+
+
+def ensure_schema():
+    # One query per process: migrates only when the database is behind this code.
+    global _up_to_date
+    if _up_to_date:
+        return
+    with get_engine().connect() as connection:
+        version = current_version(connection)
+    if version < LATEST_VERSION:
+        migrate()
+    _up_to_date = True
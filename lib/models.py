@@ -3,14 +3,20 @@ from datetime import datetime, timedelta, timezone
 
 from sqlalchemy import (
     JSON,
+    BigInteger,
     Boolean,
     Column,
     DateTime,
     Enum,
     Integer,
+    Interval,
+    Sequence,
     String,
     Text,
     TypeDecorator,
+    func,
+    literal,
+    text,
 )
 
 from lib.database import Base
@@ -22,12 +28,16 @@ class TimeStamp(TypeDecorator):
     LOCAL_TIMEZONE = datetime.utcnow().astimezone().tzinfo
 
     def process_bind_param(self, value: datetime, dialect):
+        if value is None:
+            return None
         if value.tzinfo is not None:
             value = value.astimezone(timezone.utc)
 
         return value.replace(tzinfo=None)
 
     def process_result_value(self, value, dialect):
+        if value is None:
+            return None
         if value.tzinfo is None:
             value = value.replace(tzinfo=timezone.utc)
 
@@ -36,9 +46,11 @@ class TimeStamp(TypeDecorator):
 
 class KuberState(enum.Enum):
     Empty = "Empty"
+    Deploying = "Deploying"
     Published = "Published"
     Excepted = "Excepted"
     Running = "Running"
+    Removing = "Removing"
     Removed = "Removed"
 
 
@@ -97,6 +109,22 @@ class Locale(enum.Enum):
             type(self).EN: obj.astimezone(timezone.utc),
         }[self]
 
+    def sql_time_format(self, column):
+        # time_format of a naive UTC timestamp column, computed by the database.
+        tz = self.time_format_zone(datetime.now(timezone.utc)).tzinfo
+        local = column + literal(tz.utcoffset(None), Interval())
+        return dict(
+            time=func.to_char(local, "HH24:MI"),
+            date=func.to_char(
+                local,
+                {
+                    type(self).RU: "DD.MM.YYYY",
+                    type(self).EN: "YYYY-MM-DD",
+                }[self],
+            ),
+            zone=str(tz),
+        )
+
     def time_format(self, obj):
         padded_obj = self.time_format_zone(obj)
 
@@ -139,6 +167,19 @@ class Slot(Base, JsonSerializable):
     kuber_state = Column(Enum(KuberState))
     locale = Column(Enum(Locale))
     company = Column(Text)
+    booked_at = Column(TimeStamp)
+    deploy_started_at = Column(TimeStamp)
+    published_at = Column(TimeStamp)
+    running_at = Column(TimeStamp)
+    removal_requested_at = Column(TimeStamp)
+    removed_at = Column(TimeStamp)
+    # The watcher worker working on the slot, until its lease expires or is released.
+    lease_owner = Column(String(100))
+    lease_expires_at = Column(TimeStamp)
+    # Drawn from a sequence whenever time or enabled change, so the availability cache can
+    # tell a changed window without a shared counter row for every booking to lock.
+    # The Sequence makes create_all create slot_version_seq before the table.
+    version = Column(BigInteger, Sequence("slot_version_seq"), nullable=False, server_default=text("nextval('slot_version_seq')"))
 
     def __repr__(self):
         return f"Slot(id={self.id}, time={self.time}, enabled={self.enabled}, email={self.email}, namespace={self.namespace}, password={self.password}, kuber_state={self.kuber_state}, locale={self.locale})"  # noqa
@@ -153,3 +194,13 @@ class Mail(Base, JsonSerializable):
     locale = Column(Enum(Locale), primary_key=True)
     data = Column(JSON)
     sent = Column(Boolean, default=False)
+    # Failed delivery attempts; the dispatcher gives up on a mail after a few.
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+class SlotVersion(Base):
+    __tablename__ = "slot_version"
+
+    # Superseded by Slot.version: only the baseline migration creates it, migration 6 drops it.
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
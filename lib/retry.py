@@ -0,0 +1,40 @@
+import logging
+import random
+import time
+
+import psycopg2
+from sqlalchemy.exc import DBAPIError, DisconnectionError, OperationalError
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error):
+    # Errors after which the same request can simply run again on a fresh connection.
+    if isinstance(error, (OperationalError, DisconnectionError, psycopg2.OperationalError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class RetryPolicy:
+    # Exponential backoff with full jitter, so that instances which lost the database at the
+    # same moment do not come back at the same moment too.
+    def __init__(self, attempts=3, base_delay=0.05, max_delay=1.0, retry_if=is_transient):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_if = retry_if
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, f, *args, **kwargs):
+        # Raises the last error once the attempts are spent, never returns silently.
+        for attempt in range(self.attempts):
+            try:
+                return f(*args, **kwargs)
+            except Exception as e:
+                if attempt + 1 == self.attempts or not self.retry_if(e):
+                    raise
+                delay = self.delay(attempt)
+                logger.warning("Attempt %s of %s failed, retrying in %.3fs", attempt + 1, self.attempts, delay, exc_info=True)
+                time.sleep(delay)
@@ -0,0 +1,68 @@
+import datetime
+
+from sqlalchemy import Column, MetaData, Table, bindparam, text
+
+from lib.models import Slot, TimeStamp
+
+# Not in Base.metadata: created by migrations, never by create_all.
+_metadata = MetaData()
+slot_archive = Table(
+    "slot_archive", _metadata, *(Column(column.name, column.type) for column in Slot.__table__.columns), Column("archived_at", TimeStamp)
+)
+# Hot and archived slots, for reports that look into the past.
+slot_all = Table("slot_all", _metadata, *(Column(column.name, column.type) for column in slot_archive.columns))
+
+
+def _column_list(names):
+    return ", ".join(f'"{name}"' for name in names)
+
+
+_columns = _column_list(column.name for column in Slot.__table__.columns)
+# Slots that are over and done: removed ones, and ones nobody booked. Booked slots in any
+# other state still have a namespace for the watcher to remove first. No trigger fires on
+# the DELETE (slot versions only change on UPDATE), so a batch takes no lock beyond its rows.
+ARCHIVE_BATCH = text(
+    f"""
+    WITH moved AS (
+        DELETE FROM slot WHERE id IN (
+            SELECT id FROM slot
+            WHERE time < :cutoff AND "end" < :cutoff
+                AND (kuber_state = 'Removed' OR (email = '' AND (kuber_state IS NULL OR kuber_state = 'Empty')))
+                AND (lease_expires_at IS NULL OR lease_expires_at < :now)
+            ORDER BY id
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING {_columns}
+    )
+    INSERT INTO slot_archive ({_columns}, archived_at)
+    SELECT {_columns}, :now FROM moved
+    """
+).bindparams(bindparam("cutoff", type_=TimeStamp()), bindparam("now", type_=TimeStamp()))
+
+
+def slot_all_view_sql(columns=None):
+    # Named columns, since slot and slot_archive may list them in a different order.
+    columns = _column_list(columns) if columns else _columns
+    return f"""
+    CREATE OR REPLACE VIEW slot_all AS
+    SELECT {columns}, NULL::timestamp AS archived_at FROM slot
+    UNION ALL
+    SELECT {columns}, archived_at FROM slot_archive
+    """
+
+
+def archive_slots(session_factory, older_than, batch_size=1000, max_batches=None):
+    # Moves finished slots that ended more than older_than ago, one committed batch at a time so
+    # that locks stay short. Returns the number of slots moved.
+    now = datetime.datetime.now(datetime.timezone.utc)
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        with session_factory() as session:
+            count = session.execute(ARCHIVE_BATCH, dict(cutoff=now - older_than, now=now, batch_size=batch_size)).rowcount
+            session.commit()
+        moved += count
+        batches += 1
+        if count < batch_size:
+            break
+    return moved
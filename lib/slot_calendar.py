@@ -0,0 +1,137 @@
+import datetime
+import json
+from dataclasses import dataclass, field
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+# Serializes generators, so that two of them never both see a start time as missing.
+SLOT_CALENDAR_LOCK_ID = 7302
+
+# For every wanted start time, inserts only the slots missing up to its capacity: running it
+# again, or after some slots were booked, closed or removed, creates nothing twice.
+INSERT_MISSING_SLOTS = text(
+    """
+    INSERT INTO slot (time, "end", enabled, email, namespace, password)
+    SELECT wanted.time, wanted."end", wanted.enabled, '', '', ''
+    FROM unnest(CAST(:times AS timestamp[]), CAST(:ends AS timestamp[]), CAST(:capacities AS integer[]), CAST(:enabled AS boolean[]))
+        AS wanted(time, "end", capacity, enabled)
+    CROSS JOIN LATERAL generate_series((SELECT count(*) FROM slot WHERE slot.time = wanted.time) + 1, wanted.capacity) AS copy(n)
+    RETURNING id
+    """
+)
+
+
+def _parse_time(value):
+    # "HH:MM", "24:00" is the end of the day.
+    if value == "24:00":
+        return None
+    return datetime.time.fromisoformat(value)
+
+
+@dataclass
+class SlotRule:
+    weekdays: tuple = WEEKDAYS
+    # Slots start in [start, end) local time, end None is midnight.
+    start: datetime.time = datetime.time(0)
+    end: datetime.time = None
+    interval_minutes: int = 30
+    duration_minutes: int = 120
+    # Slots created for each start time.
+    capacity: int = 1
+    enabled: bool = True
+
+    @classmethod
+    def from_dict(cls, data):
+        unknown = set(data) - {"weekdays", "from", "to", "interval_minutes", "duration_minutes", "capacity", "enabled"}
+        if unknown:
+            raise ValueError(f"Unknown slot rule fields: {', '.join(sorted(unknown))}")
+        weekdays = tuple(day.lower() for day in data.get("weekdays", WEEKDAYS))
+        if not set(weekdays) <= set(WEEKDAYS):
+            raise ValueError(f"Weekdays must be some of {', '.join(WEEKDAYS)}, got {', '.join(weekdays)}")
+        rule = cls(
+            weekdays=weekdays,
+            start=_parse_time(data.get("from", "00:00")) or datetime.time(0),
+            end=_parse_time(data.get("to", "24:00")),
+            interval_minutes=int(data.get("interval_minutes", cls.interval_minutes)),
+            duration_minutes=int(data.get("duration_minutes", cls.duration_minutes)),
+            capacity=int(data.get("capacity", cls.capacity)),
+            enabled=bool(data.get("enabled", cls.enabled)),
+        )
+        if rule.interval_minutes <= 0 or rule.duration_minutes <= 0 or rule.capacity < 0:
+            raise ValueError("interval_minutes and duration_minutes must be positive, capacity must not be negative")
+        return rule
+
+    def starts(self, day, tz):
+        # Start times on a local date, as UTC datetimes.
+        if WEEKDAYS[day.weekday()] not in self.weekdays:
+            return
+        begin = datetime.datetime.combine(day, self.start, tzinfo=tz)
+        end = datetime.datetime.combine(day + datetime.timedelta(days=1) if self.end is None else day, self.end or datetime.time(0), tzinfo=tz)
+        step = datetime.timedelta(minutes=self.interval_minutes)
+        # Wall clock steps, a DST change only shifts the slots of that night.
+        while begin < end:
+            yield begin.astimezone(datetime.timezone.utc)
+            begin += step
+
+
+@dataclass
+class SlotCalendar:
+    rules: list
+    timezone: str = "UTC"
+    blackout_dates: set = field(default_factory=set)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            rules=[SlotRule.from_dict(rule) for rule in data["rules"]],
+            timezone=data.get("timezone", "UTC"),
+            blackout_dates={datetime.date.fromisoformat(day) for day in data.get("blackout_dates", [])},
+        )
+
+    @classmethod
+    def load(cls, file):
+        return cls.from_dict(json.load(file))
+
+    @classmethod
+    def every(cls, interval_minutes, duration_minutes):
+        # What create-slots did before rules: enabled slots around the clock.
+        return cls(rules=[SlotRule(interval_minutes=interval_minutes, duration_minutes=duration_minutes)])
+
+    def slots(self, begin, end):
+        # {start: (end, capacity, enabled)} for the slots starting in [begin, end). Where rules
+        # overlap the rule with the larger capacity wins, the first listed on a tie.
+        tz = ZoneInfo(self.timezone)
+        wanted = {}
+        day = begin.astimezone(tz).date()
+        while day <= end.astimezone(tz).date():
+            if day not in self.blackout_dates:
+                for rule in self.rules:
+                    for start in rule.starts(day, tz):
+                        if not begin <= start < end:
+                            continue
+                        if start in wanted and wanted[start][1] >= rule.capacity:
+                            continue
+                        wanted[start] = (start + datetime.timedelta(minutes=rule.duration_minutes), rule.capacity, rule.enabled)
+            day += datetime.timedelta(days=1)
+        return wanted
+
+
+def generate_slots(session, calendar, begin, end):
+    # Ids of the slots created, the caller commits.
+    wanted = calendar.slots(begin, end)
+    if not wanted:
+        return []
+    session.execute(text("SELECT pg_advisory_xact_lock(:id)"), dict(id=SLOT_CALENDAR_LOCK_ID))
+    starts = sorted(wanted)
+    # The slot table keeps naive UTC timestamps.
+    return session.scalars(
+        INSERT_MISSING_SLOTS,
+        dict(
+            times=[start.replace(tzinfo=None) for start in starts],
+            ends=[wanted[start][0].replace(tzinfo=None) for start in starts],
+            capacities=[wanted[start][1] for start in starts],
+            enabled=[wanted[start][2] for start in starts],
+        ),
+    ).all()
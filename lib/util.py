@@ -10,3 +10,8 @@ def deserialize_time(isotime: str) -> datetime.datetime:
 
 def serialize_time(time: datetime.datetime) -> str:
     return time.isoformat(timespec="minutes")
+
+
+def serialize_utc(time: datetime.datetime) -> str:
+    # Naive UTC, as timestamp columns store it.
+    return time.astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat()
@@ -0,0 +1,71 @@
+import base64
+import datetime
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import click
+from sqlalchemy import delete
+
+from lib.database import db_session
+from lib.migrations import ensure_schema
+from lib.models import Mail, Slot
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def make_event(slot_id, email):
+    body = json.dumps({"slot_id": slot_id, "email": email, "locale": "en"})
+    return {"httpMethod": "POST", "body": base64.b64encode(body.encode()).decode()}
+
+
+@click.command()
+@click.option("--requests", "request_count", type=int, default=200, help="Bookings fired at the same moment")
+@click.option("--slots", "slot_count", type=int, default=5, help="Slots the burst competes for")
+def benchmark(request_count, slot_count):
+    """Fires a burst of simultaneous register calls and reports booking latency."""
+    from registration_backend.index import register
+
+    ensure_schema()
+    start = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+    with db_session() as session:
+        slots = [Slot(time=start + datetime.timedelta(minutes=i), end=start + datetime.timedelta(hours=2), enabled=True) for i in range(slot_count)]
+        session.add_all(slots)
+        session.commit()
+        slot_ids = [slot.id for slot in slots]
+
+    barrier = threading.Barrier(request_count)
+    context = SimpleNamespace(function_version="benchmark")
+
+    def book(index):
+        event = make_event(slot_ids[index % slot_count], f"benchmark-{index}@example.com")
+        barrier.wait()
+        started = time.perf_counter()
+        response = register(event, context)
+        return response["body"]["code"], time.perf_counter() - started
+
+    try:
+        with ThreadPoolExecutor(max_workers=request_count) as executor:
+            results = list(executor.map(book, range(request_count)))
+    finally:
+        with db_session() as session:
+            session.execute(delete(Mail).where(Mail.email.like("benchmark-%@example.com")).execution_options(synchronize_session=False))
+            session.execute(delete(Slot).where(Slot.id.in_(slot_ids)).execution_options(synchronize_session=False))
+            session.commit()
+
+    codes = {}
+    for code, _ in results:
+        codes[code] = codes.get(code, 0) + 1
+    latencies = [elapsed * 1000 for _, elapsed in results]
+    click.echo(f"responses: {dict(sorted(codes.items()))}")
+    click.echo(" ".join(f"p{q}: {percentile(latencies, q):.1f} ms" for q in (50, 90, 99)) + f" max: {max(latencies):.1f} ms")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,21 +1,30 @@
 import base64
+import bisect
 import datetime
 import functools
 import json
 import logging
+import time
 import traceback
 import uuid
 
 import click
-import psycopg2
-from sqlalchemy import select
+from sqlalchemy import String, bindparam, exists, func, insert, literal, select, update
 
 from lib import util
-from lib.database import db_session, init_db
+from lib.database import db_session, execute_prepared
+from lib.logs import configure_levels
+from lib.migrations import ensure_schema
 from lib.models import KuberState, Locale, Mail, MailReason, Slot
+from lib.retry import RetryPolicy, is_transient
+
+configure_levels()
 
 DEBUG_MODE = True
 PG_RETRY_COUNT = 3
+retry_policy = RetryPolicy(attempts=PG_RETRY_COUNT)
+# Cache hits skip even the version check for this long.
+TIMESLOTS_VERSION_CHECK_SECONDS = 1
 
 if __name__ == "__main__":
 
@@ -24,7 +33,10 @@ if __name__ == "__main__":
         pass
 
 
-def make_response(code, result=None, exception=None, version="unversioned"):
+def make_response(code, result=None, exception=None, version="unversioned", headers=None):
+    if code == 304:
+        return {"statusCode": 304, "headers": dict(headers or {}), "isBase64Encoded": False, "body": ""}
+
     body = {"code": code, "version": version}
     if result is not None:
         body["result"] = result
@@ -32,7 +44,7 @@ def make_response(code, result=None, exception=None, version="unversioned"):
     if exception is not None and DEBUG_MODE:
         body["error"] = traceback.format_exc()
 
-    return {"statusCode": 200, "headers": {"Content-Type": "application/json"}, "isBase64Encoded": False, "body": body}
+    return {"statusCode": 200, "headers": {"Content-Type": "application/json", **(headers or {})}, "isBase64Encoded": False, "body": body}
 
 
 def make_cloud_function(f):
@@ -42,8 +54,8 @@ def make_cloud_function(f):
         @click.option("--data")
         @functools.wraps(f)
         def callback(data):
-            code, result = f(dict(body=data), None)
-            response = make_response(code, result=result, version="cmd")
+            code, result, *headers = f(dict(body=data), None)
+            response = make_response(code, result=result, version="cmd", headers=headers[0] if headers else None)
             click.echo(json.dumps(response))
 
         return callback
@@ -60,13 +72,13 @@ def make_cloud_function(f):
                 },
             )
         try:
-            for i in range(PG_RETRY_COUNT):
-                try:
-                    code, result = f(event, context)
-                    return make_response(code, result=result, version=context.function_version)
-                except psycopg2.OperationalError:
-                    logging.exception("psycopg exception")
+            # Functions may return response headers as an optional third element.
+            code, result, *headers = retry_policy.call(f, event, context)
+            return make_response(code, result=result, version=context.function_version, headers=headers[0] if headers else None)
         except Exception as e:
+            if is_transient(e):
+                logging.exception("Database is unavailable")
+                return make_response(503, exception=e, version=context.function_version)
             logging.exception("Got an exception in function")
             return make_response(500, exception=e, version=context.function_version)
 
@@ -80,21 +92,87 @@ def get_time_boundary():
     return time_from, time_to
 
 
+# Count and version sum of the slots in a window: any committed change to them changes it,
+# in whichever order the changes commit.
+slot_version_query = (
+    select(func.count(), func.coalesce(func.sum(Slot.version), 0))
+    .where(Slot.time >= bindparam("since", type_=Slot.time.type))
+    .where(Slot.time < bindparam("time_to", type_=Slot.time.type))
+)
+timeslots_query = (
+    select(Slot.id, Slot.time, Slot.enabled, Slot.version)
+    .where(Slot.time >= bindparam("now", type_=Slot.time.type))
+    .where(Slot.time < bindparam("time_to", type_=Slot.time.type))
+    .order_by(Slot.time, Slot.id)
+)
+
+
+def get_header(event, name):
+    for key, value in (event.get("headers") or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+class TimeslotsCache:
+    # Slots from now to the end of the window, keyed by their count and version sum. The
+    # lower bound of the window moves with time, so requests slice the cached list
+    # instead of querying again.
+    def __init__(self, version_check_interval=TIMESLOTS_VERSION_CHECK_SECONDS):
+        self.version_check_interval = version_check_interval
+        self.version = None
+        self.version_checked_at = None
+        self.since = None
+        self.time_to = None
+        self.times = []
+        self.payload = []
+        # version_sums[i] is the version sum of the slots from i on.
+        self.version_sums = [0]
+
+    def current_version(self, session):
+        now = time.monotonic()
+        if self.version_checked_at is None or now - self.version_checked_at >= self.version_check_interval:
+            self.version_checked_at = now
+            row = execute_prepared(session, "slot_version", slot_version_query, dict(since=self.since, time_to=self.time_to)).one()
+            return tuple(int(value) for value in row)
+        return self.version
+
+    def refresh(self, session, time_to):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rows = execute_prepared(session, "timeslots", timeslots_query, dict(now=now, time_to=time_to)).all()
+        self.version_sums = [0] * (len(rows) + 1)
+        for i in reversed(range(len(rows))):
+            self.version_sums[i] = self.version_sums[i + 1] + rows[i].version
+        self.version = (len(rows), self.version_sums[0])
+        self.version_checked_at = time.monotonic()
+        self.since = now
+        self.time_to = time_to
+        self.times = [row.time for row in rows]
+        self.payload = [dict(id=row.id, time=util.serialize_time(row.time), enabled=row.enabled) for row in rows]
+
+    def get(self, session, time_from, time_to):
+        if time_to != self.time_to or self.current_version(session) != self.version:
+            self.refresh(session, time_to)
+        start = bisect.bisect_left(self.times, time_from)
+        result = self.payload[start:]
+        # Same slots, versions and window end mean the same payload on any instance.
+        etag = f'"{len(result)}.{self.version_sums[start]}-{self.time_to.date().isoformat()}"'
+        return etag, result
+
+
+timeslots_cache = TimeslotsCache()
+
+
 @make_cloud_function
 def timeslots(event, context):
     time_from, time_to = get_time_boundary()
     with db_session() as session:
-        query = select(Slot)
-        if time_from is not None:
-            query = query.where(Slot.time >= time_from)
-        if time_to is not None:
-            query = query.where(Slot.time < time_to)
-        query = query.order_by(Slot.time)
-
-        return (
-            200,
-            [dict(id=slot.id, time=util.serialize_time(slot.time), enabled=slot.enabled) for slot in session.scalars(query)],
-        )
+        etag, result = timeslots_cache.get(session, time_from, time_to)
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if get_header(event, "If-None-Match") == etag:
+        return 304, None, headers
+    return 200, result, headers
 
 
 def parse_event(event):
@@ -104,57 +182,107 @@ def parse_event(event):
         raise Exception(event)
 
 
+@functools.lru_cache(maxsize=None)
+def booking_statement(locale):
+    # Built once per locale and executed with bind parameters, so a booking burst does not
+    # spend its time constructing and compiling the same statement over and over.
+    # SKIP LOCKED: a concurrent booking of the same slot loses at once instead of queueing.
+    claimable = (
+        select(Slot.id)
+        .where(Slot.id == bindparam("slot_id"))
+        .where(Slot.enabled)
+        .where(Slot.time >= bindparam("time_from", type_=Slot.time.type))
+        .where(Slot.time <= bindparam("time_to", type_=Slot.time.type))
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    claimed = (
+        update(Slot)
+        .where(Slot.id == claimable)
+        .values(
+            email=bindparam("email", type_=Slot.email.type),
+            enabled=False,
+            namespace=bindparam("namespace", type_=Slot.namespace.type),
+            password=bindparam("password", type_=Slot.password.type),
+            locale=locale,
+            kuber_state=KuberState.Empty,
+            company=bindparam("company", type_=Slot.company.type),
+            booked_at=bindparam("now", type_=Slot.booked_at.type),
+        )
+        .returning(Slot.id, Slot.time)
+        .cte("claimed")
+    )
+    greeting = (
+        insert(Mail)
+        .from_select(
+            [Mail.time_to_send, Mail.email, Mail.reason, Mail.locale, Mail.data, Mail.sent],
+            select(
+                bindparam("now", type_=Mail.time_to_send.type),
+                bindparam("email", type_=Mail.email.type),
+                literal(MailReason.Greeting, Mail.reason.type),
+                literal(locale, Mail.locale.type),
+                func.json_build_object(
+                    "url",
+                    bindparam("url", type_=String),
+                    "user",
+                    "admin",
+                    "password",
+                    bindparam("password", type_=String),
+                    "namespace",
+                    bindparam("namespace", type_=String),
+                    *[item for key, value in locale.sql_time_format(claimed.c.time).items() for item in (key, value)],
+                ),
+                literal(False),
+            ).select_from(claimed),
+        )
+        .returning(Mail.email)
+        .cte("greeting")
+    )
+    # The greeting is inserted by the same statement, so it is there exactly when the slot was
+    # claimed. Whether the slot exists at all is answered here too, so losers need no second query.
+    return select(
+        select(func.count()).select_from(greeting).scalar_subquery().label("booked"),
+        exists()
+        .where(Slot.id == bindparam("slot_id"))
+        .where(Slot.time >= bindparam("time_from", type_=Slot.time.type))
+        .where(Slot.time <= bindparam("time_to", type_=Slot.time.type))
+        .label("found"),
+    )
+
+
 @make_cloud_function
 def register(event, context):
     time_from, time_to = get_time_boundary()
-    with db_session() as session:
-        body = parse_event(event)
-        try:
-            slot_id = body["slot_id"]
-            email = body["email"]
-            locale = body["locale"]
-            company = body.get("company", "")
-        except KeyError:
-            return 400, {}
-
-        slot = session.get(Slot, slot_id, with_for_update=True)
-        if slot is None or slot.time > time_to or slot.time < time_from:
-            return 404, {}
-        if not slot.enabled:
-            return 409, {}
-
-        now = datetime.datetime.now(datetime.timezone.utc)
+    body = parse_event(event)
+    try:
+        slot_id = body["slot_id"]
+        email = body["email"]
+        locale = body["locale"]
+        company = body.get("company", "")
+    except KeyError:
+        return 400, {}
 
-        slot.email = email
-        slot.enabled = False
-        slot.namespace = uuid.uuid4().hex[:8]
-        slot.password = f"{uuid.uuid4().hex}"
-        slot.locale = Locale.from_front_value(locale)
-        slot.kuber_state = KuberState.Empty
-        slot.company = company
-
-        slot.time = slot.time
-
-        session.add(
-            Mail(
-                time_to_send=now,
-                email=email,
-                reason=MailReason.Greeting,
-                locale=Locale.from_front_value(locale),
-                data=dict(
-                    url=f"https://jupyter-{slot.namespace}.demo.ytsaurus.tech",
-                    user="admin",
-                    password=slot.password,
-                    namespace=slot.namespace,
-                    **Locale.from_front_value(locale).time_format(slot.time),
-                ),
-            )
-        )
-        session.add(slot)
-        session.commit()
-        return 200, {}
+    namespace = uuid.uuid4().hex[:8]
+    params = dict(
+        slot_id=slot_id,
+        email=email,
+        company=company,
+        namespace=namespace,
+        password=f"{uuid.uuid4().hex}",
+        url=f"https://jupyter-{namespace}.demo.ytsaurus.tech",
+        time_from=time_from,
+        time_to=time_to,
+        now=datetime.datetime.now(datetime.timezone.utc),
+    )
+    with db_session() as session:
+        locale = Locale.from_front_value(locale)
+        outcome = execute_prepared(session, f"booking_{locale.name.lower()}", booking_statement(locale), params).one()
+        if outcome.booked:
+            session.commit()
+            return 200, {}
+        return (409, {}) if outcome.found else (404, {})
 
 
 if __name__ == "__main__":
-    init_db()
+    ensure_schema()
     main()
@@ -4,10 +4,11 @@ logger = logging.getLogger(__name__)
 
 
 def templates_without_crd():
-    from k8s_deployer.stub import jinja_env
+    from k8s_deployer.stub import get_jinja_env
 
-    return jinja_env.list_templates(
+    return get_jinja_env().list_templates(
         filter_func=lambda name: name.endswith(".yaml")
+        and not name.startswith("pool/")
         and name
         not in {
             "namespace.yaml",
@@ -24,10 +25,12 @@ def templates_without_crd():
 
 
 class NotNamespaceCreator:
-    def __init__(self, ctx, name, manual):
+    def __init__(self, ctx, name, manual, resume=False, labels=()):
         self.ctx = ctx
         self.name = name
         self.manual = manual
+        self.resume = resume
+        self.labels = labels
 
     def __enter__(self):
         logger.info("In testing NameSpaceCreator. Will not create namespace")
@@ -38,6 +41,35 @@ class NotNamespaceCreator:
             logger.exception(f"Got exception in Testing NamespaceCreator. Will remove namespace: ({exc_type}) {exc_tb}")
 
 
+class FakeResult(list):
+    def all(self):
+        return list(self)
+
+
+class FakeSession:
+    # Stands in for db_session(): records the statements instead of running them and
+    # answers each with the rows answer(statement) returns.
+    def __init__(self, answer=lambda statement: []):
+        self.answer = answer
+        self.statements = []
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return FakeResult(self.answer(statement))
+
+    scalars = execute
+
+    def commit(self):
+        self.commits += 1
+
+
 def run_cli_without_runner(command):
     from k8s_deployer.cli import main
 
@@ -0,0 +1,51 @@
+import json
+import logging
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+logger = logging.getLogger(__name__)
+
+# Modules each cloud function must not load before its handler is invoked.
+FORBIDDEN_IMPORTS = {
+    "register": ["kubernetes", "jinja2", "k8s_deployer"],
+    "timeslots": ["kubernetes", "jinja2", "k8s_deployer"],
+    "create_function": ["jinja2", "k8s_deployer.steps", "k8s_deployer.db_watcher", "k8s_deployer.monitoring"],
+    "db_watcher_function": ["jinja2", "k8s_deployer.steps", "k8s_deployer.db_watcher", "k8s_deployer.monitoring"],
+    "remove_function": ["jinja2", "k8s_deployer.steps", "k8s_deployer.db_watcher", "k8s_deployer.monitoring"],
+    "send_monitoring_metrics": ["jinja2", "k8s_deployer.steps", "k8s_deployer.db_watcher", "k8s_deployer.monitoring"],
+}
+
+
+def import_report(handler):
+    # `-X importtime` prints one line per module with its self and cumulative microseconds. It does not
+    # see modules loaded through importlib, so the loaded set itself is taken from sys.modules.
+    code = (
+        f"import json, sys, cloud_functions; cloud_functions.load_handler({handler!r}); "
+        "import lib.database; assert lib.database._engine is None; print(json.dumps(sorted(sys.modules)))"
+    )
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+
+    timings = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        timings[name.strip()] = int(cumulative)
+    return json.loads(process.stdout), timings
+
+
+@pytest.mark.parametrize("handler", sorted(FORBIDDEN_IMPORTS))
+def test_entrypoint_imports(handler):
+    modules, timings = import_report(handler)
+    slowest = sorted(timings.items(), key=lambda item: -item[1])[:10]
+    report = f"{handler}: {len(modules)} modules, slowest: " + ", ".join(f"{name} {us / 1000:.1f}ms" for name, us in slowest)
+    logger.info(report)
+
+    loaded = [name for name in modules for forbidden in FORBIDDEN_IMPORTS[handler] if name == forbidden or name.startswith(forbidden + ".")]
+    assert not loaded, f"{handler} imports {loaded} before it is invoked ({report})"
@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from k8s_deployer import leases
+from k8s_deployer.db_watcher import deployable
+from lib.models import KuberState, Slot
+
+from .mockers import FakeSession
+
+
+@pytest.fixture
+def fake_session(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr("lib.database.db_session", lambda: session)
+    return session
+
+
+def compile_statement(statement):
+    return statement.compile(dialect=postgresql.dialect())
+
+
+def test_renew_extends_held_leases_and_drops_lost_ones(fake_session):
+    fake_session.answer = lambda statement: [1, 3]
+    heartbeat = leases.LeaseHeartbeat()
+    heartbeat.add([1, 2, 3])
+
+    before = datetime.datetime.now(datetime.timezone.utc)
+    heartbeat.renew()
+
+    assert heartbeat.slot_ids == {1, 3}
+    assert fake_session.commits == 1
+    compiled = compile_statement(fake_session.statements[0])
+    assert "slot.lease_owner = %(lease_owner_1)s" in str(compiled)
+    assert compiled.params["lease_owner_1"] == leases.WORKER_ID
+    assert sorted(compiled.params["id_1"]) == [1, 2, 3]
+    assert compiled.params["lease_expires_at"] >= before + datetime.timedelta(seconds=leases.LEASE_SECONDS)
+
+
+def test_renew_without_slots_does_not_query(fake_session):
+    leases.LeaseHeartbeat().renew()
+
+    assert fake_session.statements == []
+
+
+def test_claim_skips_locked_rows_and_live_leases(fake_session):
+    leases.claim_slots([Slot.email != ""], [Slot.id], batch_size=5, exclude_ids=[7], kuber_state=KuberState.Deploying)
+
+    assert fake_session.commits == 1
+    compiled = compile_statement(fake_session.statements[0])
+    sql = str(compiled)
+    assert "FOR UPDATE SKIP LOCKED" in sql
+    assert "slot.lease_expires_at IS NULL OR slot.lease_expires_at < %(lease_expires_at_1)s" in sql
+    assert "slot.id NOT IN" in sql
+    assert "RETURNING slot.id, candidates.previous_owner" in sql
+    assert compiled.params["param_1"] == 5
+    assert compiled.params["lease_owner"] == leases.WORKER_ID
+    assert compiled.params["kuber_state"] == KuberState.Deploying
+
+
+def test_deployable_takes_over_only_expired_deploys():
+    now = datetime.datetime(2026, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    compiled = compile_statement(deployable(now, 15))
+
+    # Booked slots due for deploy, or deploys whose worker let the lease expire before the slot ended.
+    assert str(compiled) == (
+        "slot.email != %(email_1)s AND slot.time >= %(time_1)s AND slot.time < %(time_2)s AND slot.kuber_state = %(kuber_state_1)s"
+        ' OR slot.kuber_state = %(kuber_state_2)s AND slot.lease_expires_at < %(lease_expires_at_1)s AND slot."end" > %(end_1)s'
+    )
+    assert compiled.params == {
+        "email_1": "",
+        "time_1": now - datetime.timedelta(minutes=15),
+        "time_2": now + datetime.timedelta(minutes=15),
+        "kuber_state_1": KuberState.Empty,
+        "kuber_state_2": KuberState.Deploying,
+        "lease_expires_at_1": now,
+        "end_1": now,
+    }
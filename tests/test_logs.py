@@ -0,0 +1,53 @@
+import json
+import logging
+import queue
+import sys
+
+from lib.logs import JsonFormatter, LazyQueueHandler, Pretty, SamplingFilter
+
+
+def make_record(name, level=logging.INFO, msg="message %s", args=("argument",)):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_sampling_filter():
+    sampling = SamplingFilter({"yt-demo.probes": 0.25, "yt-demo.probes.ui": 0.5})
+
+    passed = [sampling.filter(make_record("yt-demo.probes")) for _ in range(8)]
+    assert passed == [True, False, False, False, True, False, False, False]
+    # The most specific source wins, other loggers and warnings are never sampled.
+    assert sum(sampling.filter(make_record("yt-demo.probes.ui.login")) for _ in range(8)) == 4
+    assert all(sampling.filter(make_record("yt-demo.probes", level=logging.WARNING)) for _ in range(8))
+    assert all(sampling.filter(make_record("yt-demo.db_watcher")) for _ in range(8))
+
+
+def test_message_is_formatted_by_listener():
+    formatted = []
+
+    class Probe:
+        def __repr__(self):
+            formatted.append(True)
+            return "probe"
+
+    records = queue.Queue()
+    LazyQueueHandler(records).handle(make_record("yt-demo", args=(Pretty({"kind": Probe()}),)))
+    assert not formatted
+
+    record = json.loads(JsonFormatter().format(records.get_nowait()))
+    assert formatted
+    assert record["message"] == "message {'kind': probe}"
+
+
+def test_json_record():
+    try:
+        raise ValueError("broken")
+    except ValueError:
+        record = logging.LogRecord("yt-demo.steps", logging.ERROR, __file__, 7, "failed %s", ("slot",), sys.exc_info())
+    record.slot = 42
+
+    data = json.loads(JsonFormatter().format(record))
+    assert data["level"] == "ERROR"
+    assert data["logger"] == "yt-demo.steps"
+    assert data["message"] == "failed slot"
+    assert data["slot"] == 42
+    assert "ValueError: broken" in data["exception"]
@@ -0,0 +1,162 @@
+import datetime
+import email
+import smtplib
+import socketserver
+import threading
+from email.policy import default
+
+import pytest
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import Select
+
+from k8s_deployer.mail_dispatcher import MailTemplates, SmtpSettings, dispatch_mail, send_batch
+from lib.models import Locale, Mail, MailReason
+
+from .mockers import FakeSession
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib: refuses recipients starting with "refused",
+    # drops the connection on recipients starting with "drop".
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 fake ESMTP")
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+            if not line or command == "QUIT":
+                self.reply("221 bye")
+                return
+            if command in ("EHLO", "HELO"):
+                self.reply("250 fake")
+            elif command == "RCPT":
+                address = line.split(":", 1)[1].strip("<> ")
+                if address.startswith("drop"):
+                    return
+                if address.startswith("refused"):
+                    self.reply("550 no such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 ok")
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while (line := self.rfile.readline()) != b".\r\n":
+                    data.append(line)
+                self.server.messages.append((recipients, email.message_from_bytes(b"".join(data), policy=default)))
+                recipients = []
+                self.reply("250 queued")
+            else:
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), FakeSmtpHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.messages = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_mail(address, reason=MailReason.Greeting, locale=Locale.EN):
+    time = datetime.datetime(2024, 5, 1, 12, tzinfo=datetime.timezone.utc)
+    data = dict(
+        url="https://jupyter-abc.demo.ytsaurus.tech",
+        jupyter_url="https://jupyter-abc.demo.ytsaurus.tech",
+        ytsaurus_url="https://yt-abc.demo.ytsaurus.tech/ytdemo",
+        datalens_url="https://datalens-abc.demo.ytsaurus.tech/ytdemo",
+        button_url="https://jupyter-abc.demo.ytsaurus.tech/lab",
+        user="admin",
+        password="secret-password",
+        namespace="abc",
+        **locale.time_format(time),
+    )
+    return Mail(time_to_send=time, email=address, reason=reason, locale=locale, data=data, sent=False)
+
+
+def test_send_batch(smtp_server):
+    smtp = SmtpSettings("127.0.0.1", smtp_server.server_address[1], security="none").connect()
+    mails = [
+        make_mail("first@example.com"),
+        make_mail("refused@example.com"),
+        make_mail("second@example.com", MailReason.Reminder, Locale.RU),
+    ]
+    sent, failed = send_batch(smtp, MailTemplates(), mails, "demo@example.com")
+    smtp.quit()
+
+    assert [mail.email for mail, _ in sent] == ["first@example.com", "second@example.com"]
+    assert [mail.email for mail in failed] == ["refused@example.com"]
+    assert smtp_server.connections == 1
+
+    (first_to, first), (second_to, second) = smtp_server.messages
+    assert first_to == ["first@example.com"]
+    assert first["Subject"] == Locale.EN.to_subject(MailReason.Greeting)
+    assert "secret-password" in first.get_content()
+    assert second["Subject"] == Locale.RU.to_subject(MailReason.Reminder)
+    assert "https://jupyter-abc.demo.ytsaurus.tech/lab" in second.get_content()
+
+
+def test_send_batch_stops_on_broken_connection(smtp_server):
+    smtp = SmtpSettings("127.0.0.1", smtp_server.server_address[1], security="none").connect()
+    mails = [make_mail("first@example.com"), make_mail("drop@example.com"), make_mail("second@example.com")]
+    sent, failed = send_batch(smtp, MailTemplates(), mails, "demo@example.com")
+    smtp.close()
+
+    assert [mail.email for mail, _ in sent] == ["first@example.com"]
+    assert failed == []
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        smtp.noop()
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    # Claims answer with the queued batches, updates are recorded.
+    session = FakeSession()
+    session.batches = []
+    session.answer = lambda statement: session.batches.pop(0) if isinstance(statement, Select) and session.batches else []
+    monkeypatch.setattr("lib.database.db_session", lambda: session)
+    return session
+
+
+def updates(session):
+    # (column set, addresses) of every UPDATE dispatch_mail ran.
+    result = []
+    for statement in session.statements:
+        if isinstance(statement, Select):
+            continue
+        compiled = statement.compile(dialect=postgresql.dialect())
+        column = "sent" if "sent" in compiled.params else "attempts"
+        result.append((column, sorted(email for _, email, _, _ in compiled.params["param_1"])))
+    return result
+
+
+def test_dispatch_mail(smtp_server, outbox):
+    outbox.batches = [[make_mail("first@example.com"), make_mail("refused@example.com")], [make_mail("second@example.com")]]
+    settings = SmtpSettings("127.0.0.1", smtp_server.server_address[1], sender="demo@example.com", security="none")
+
+    assert dispatch_mail(settings, MailTemplates(), batch_size=2) == (2, 1)
+    assert updates(outbox) == [
+        ("sent", ["first@example.com"]),
+        ("attempts", ["refused@example.com"]),
+        ("sent", ["second@example.com"]),
+    ]
+    assert outbox.commits == 2
+    assert smtp_server.connections == 2
+
+
+def test_dispatch_mail_does_not_count_broken_connections(smtp_server, outbox):
+    outbox.batches = [[make_mail("first@example.com"), make_mail("drop@example.com"), make_mail("second@example.com")]]
+    settings = SmtpSettings("127.0.0.1", smtp_server.server_address[1], sender="demo@example.com", security="none")
+
+    # The dropped mail and the rest of the batch stay unsent with their attempts untouched.
+    assert dispatch_mail(settings, MailTemplates()) == (1, 0)
+    assert updates(outbox) == [("sent", ["first@example.com"])]
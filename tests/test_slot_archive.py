@@ -0,0 +1,57 @@
+import datetime
+import os
+
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from lib.models import KuberState, Slot
+
+pytestmark = pytest.mark.skipif("DB_HOST" not in os.environ, reason="needs a Postgres database, DB_* variables")
+
+UTC = datetime.timezone.utc
+# Long before any real slot, so that only the slots made here are old enough to move.
+CUTOFF = datetime.datetime(1990, 1, 2, tzinfo=UTC)
+NOW = datetime.datetime(1990, 1, 3, tzinfo=UTC)
+
+
+@pytest.fixture
+def session():
+    from lib.database import get_engine
+    from lib.migrations import ensure_schema
+
+    ensure_schema()
+    with get_engine().connect() as connection:
+        transaction = connection.begin()
+        yield Session(bind=connection)
+        transaction.rollback()
+
+
+def make_slot(session, name, hours_before_cutoff=24, duration_hours=2, **values):
+    time = CUTOFF - datetime.timedelta(hours=hours_before_cutoff)
+    values = {**dict(time=time, end=time + datetime.timedelta(hours=duration_hours), enabled=False, email="", namespace=name, password=""), **values}
+    return session.execute(insert(Slot).values(**values).returning(Slot.id)).scalar()
+
+
+def test_archives_only_finished_slots(session):
+    from lib.slot_archive import ARCHIVE_BATCH, slot_archive
+
+    slots = {
+        "removed": make_slot(session, "removed", email="a@b", kuber_state=KuberState.Removed),
+        "never booked": make_slot(session, "never booked"),
+        "never deployed": make_slot(session, "never deployed", kuber_state=KuberState.Empty),
+        "booked": make_slot(session, "booked", email="a@b", kuber_state=KuberState.Empty),
+        "running": make_slot(session, "running", email="a@b", kuber_state=KuberState.Running),
+        "removing": make_slot(session, "removing", email="a@b", kuber_state=KuberState.Removing),
+        "ends after cutoff": make_slot(session, "ends after cutoff", duration_hours=48),
+        "leased": make_slot(session, "leased", lease_owner="worker", lease_expires_at=NOW + datetime.timedelta(minutes=1)),
+        "lease expired": make_slot(session, "lease expired", lease_owner="worker", lease_expires_at=NOW - datetime.timedelta(minutes=1)),
+    }
+
+    moved = session.execute(ARCHIVE_BATCH, dict(cutoff=CUTOFF, now=NOW, batch_size=100)).rowcount
+
+    archived = set(session.scalars(select(slot_archive.c.namespace).where(slot_archive.c.id.in_(slots.values()))))
+    assert archived == {"removed", "never booked", "never deployed", "lease expired"}
+    assert moved == len(archived)
+    left = set(session.scalars(select(Slot.namespace).where(Slot.id.in_(slots.values()))))
+    assert left == set(slots) - archived
@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+
+from lib.slot_calendar import SlotCalendar
+
+UTC = datetime.timezone.utc
+
+
+def test_business_hours():
+    calendar = SlotCalendar.from_dict(
+        {
+            "timezone": "Europe/Moscow",
+            "blackout_dates": ["2024-05-01"],
+            "rules": [
+                {"weekdays": ["mon", "tue", "wed", "thu", "fri"], "from": "10:00", "to": "12:00", "interval_minutes": 60, "capacity": 2},
+                {"weekdays": ["wed"], "from": "11:00", "to": "13:00", "interval_minutes": 60, "duration_minutes": 30},
+            ],
+        }
+    )
+    # Monday 2024-04-29 to Thursday 2024-05-02 morning, Wednesday is a holiday.
+    slots = calendar.slots(datetime.datetime(2024, 4, 29, tzinfo=UTC), datetime.datetime(2024, 5, 2, 7, 30, tzinfo=UTC))
+
+    assert sorted(slots) == [
+        datetime.datetime(2024, 4, 29, 7, tzinfo=UTC),
+        datetime.datetime(2024, 4, 29, 8, tzinfo=UTC),
+        datetime.datetime(2024, 4, 30, 7, tzinfo=UTC),
+        datetime.datetime(2024, 4, 30, 8, tzinfo=UTC),
+        datetime.datetime(2024, 5, 2, 7, tzinfo=UTC),
+    ]
+    assert slots[datetime.datetime(2024, 4, 29, 7, tzinfo=UTC)] == (datetime.datetime(2024, 4, 29, 9, tzinfo=UTC), 2, True)
+
+
+def test_overlapping_rules_take_larger_capacity():
+    calendar = SlotCalendar.from_dict(
+        {"rules": [{"capacity": 1, "interval_minutes": 60}, {"from": "12:00", "to": "13:00", "capacity": 3, "duration_minutes": 60}]}
+    )
+    slots = calendar.slots(datetime.datetime(2024, 5, 1, 11, tzinfo=UTC), datetime.datetime(2024, 5, 1, 14, tzinfo=UTC))
+
+    assert {start.hour: capacity for start, (_, capacity, _) in slots.items()} == {11: 1, 12: 3, 13: 1}
+    # Around the clock by default.
+    assert len(SlotCalendar.every(30, 120).slots(datetime.datetime(2024, 5, 1, tzinfo=UTC), datetime.datetime(2024, 5, 2, tzinfo=UTC))) == 48
+
+
+def test_overlapping_rules_keep_the_winning_rule():
+    calendar = SlotCalendar.from_dict(
+        {
+            "rules": [
+                {"from": "16:00", "to": "17:00", "capacity": 3, "duration_minutes": 60},
+                {"from": "16:00", "to": "17:00", "capacity": 1, "duration_minutes": 240, "enabled": False},
+            ]
+        }
+    )
+    start = datetime.datetime(2024, 5, 1, 16, tzinfo=UTC)
+    slots = calendar.slots(start, start + datetime.timedelta(minutes=30))
+
+    assert slots == {start: (start + datetime.timedelta(hours=1), 3, True)}
+
+
+def test_invalid_rule():
+    with pytest.raises(ValueError):
+        SlotCalendar.from_dict({"rules": [{"weekdays": ["monday"]}]})
+    with pytest.raises(ValueError):
+        SlotCalendar.from_dict({"rules": [{"interval": 30}]})